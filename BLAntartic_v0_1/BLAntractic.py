@@ -10,12 +10,16 @@ import sys
 import os
 
 import blastp
+import cache
 import dirs
+import manifest
 import muscle
 import parse_input
+import prefilter
 import prosite
 import plot
 import saveproject
+import scheduler
 
 
 script_name = sys.argv[0]
@@ -39,7 +43,13 @@ def use(script_name):
               utilizar como query/queries.
 
             opcional: [-h] [--eval blast_evalue] [--ident blast_identity]
-                    [--cov blast_coverage] [--exclude] [-o project.bapj]""".format(script_name))
+                    [--cov blast_coverage] [--exclude] [--threads n]
+                    [--workers n] [--jobs n] [--gb-parser fast|biopython]
+                    [--dedup] [--max-aligned n] [--prefilter n]
+                    [--prefilter-report] [-o project.bapj]
+                    [--refilter project.bapj] [--resume]
+                    [--cache-budget GB] [--pipeline]
+                    [--export-alignments]""".format(script_name))
 
 
 def help():
@@ -57,10 +67,23 @@ cov_threshold = 50
 ident_threshold = 30
 exclude = False
 opening = False
+refiltering = False
+resume = False
+num_threads = os.cpu_count() or 1
+workers = 1
+jobs = os.cpu_count() or 1
+gb_parser = "fast"
+dedup = False
+max_aligned = None
+prefilter_seeds = None
+prefilter_report = False
+cache_budget = cache.DEFAULT_BUDGET
+pipeline = False
+export_alignments = False
 
 # Extrae las opciones y argumentos posicionales.
 try:
-    opts, argumentos = getopt.getopt(argv0, 'n:hs:q:o:', ['eval=', 'ident=', 'cov=', 'exclude'])
+    opts, argumentos = getopt.getopt(argv0, 'n:hs:q:o:', ['eval=', 'ident=', 'cov=', 'exclude', 'threads=', 'workers=', 'jobs=', 'gb-parser=', 'dedup', 'max-aligned=', 'prefilter=', 'prefilter-report', 'refilter=', 'resume', 'cache-budget=', 'pipeline', 'export-alignments'])
 
 except getopt.GetoptError:
     print("ERROR: Error en las opciones o argumentos introducidos.")
@@ -84,7 +107,24 @@ for o, a in opts:
         opening = True
         open_path = str(a)
 
-    elif o == "--evalue":
+    elif o == "--refilter":
+        opening = True
+        refiltering = True
+        open_path = str(a)
+
+    elif o == "--resume":
+        resume = True
+
+    elif o == "--cache-budget":
+        cache_budget = int(float(a) * (1 << 30))
+
+    elif o == "--pipeline":
+        pipeline = True
+
+    elif o == "--export-alignments":
+        export_alignments = True
+
+    elif o == "--eval":
         eval_threshold = float(a)
 
     elif o == "--ident":
@@ -96,6 +136,30 @@ for o, a in opts:
     elif o in "--exclude":
         exclude = True
 
+    elif o == "--threads":
+        num_threads = int(a)
+
+    elif o == "--workers":
+        workers = int(a)
+
+    elif o == "--jobs":
+        jobs = int(a)
+
+    elif o == "--gb-parser":
+        gb_parser = str(a)
+
+    elif o == "--dedup":
+        dedup = True
+
+    elif o == "--max-aligned":
+        max_aligned = int(a)
+
+    elif o == "--prefilter":
+        prefilter_seeds = int(a)
+
+    elif o == "--prefilter-report":
+        prefilter_report = True
+
 if opening == False:
     try:
         subjects_directory
@@ -112,9 +176,16 @@ parse_input.check_dbs()
 
 if opening == False:
 
-    # Crea los directorios de resultados y datos.
-    print("Creando directorios...")
-    indice = dirs.calcula_indice(project_name)
+    # Crea los directorios de resultados y datos. Al reanudar, se reutilizan
+    # los últimos creados con ese nombre de proyecto.
+    indice = None
+    if resume:
+        indice = dirs.ultimo_indice(project_name)
+        if indice is None:
+            print("No hay ninguna ejecución previa de '{}'; se empieza de cero.".format(project_name))
+    if indice is None:
+        print("Creando directorios...")
+        indice = dirs.calcula_indice(project_name)
     path_results, path_data = dirs.crea_directorios(indice, project_name,  "results", "data")
 
     # Almacena los paths de los directorios creados en una instancia de la clase
@@ -123,78 +194,363 @@ if opening == False:
     estruct_dir.add_results(path_results)
     estruct_dir.add_data(path_data)
 
-    # Parsea los fichero de input y extrae secuencias, etc.
-    print("Procesando inputs...")
-    parse_input.make_genomes_multifasta(subjects_directory, estruct_dir)
-    queries = parse_input.preprocess_queries(queries_file, estruct_dir)
-    # parse_input.store_GBs_copies(subjects_directory, estruct_dir)
-
-    # Hace el BLAST y almacena los resultados en un fichero XML.
-    print("Haciendo BLAST...")
-    blastp.blast_it(estruct_dir, eval_threshold, cov_threshold)
-
-    # Filtra los resultados del blast por identidad.
-    print("Filtrando BLAST...")
-    blastp.filter_ident(estruct_dir, ident_threshold)
-
-    # Almacena cada resultado del blast en una instancia de la clase Protein.
-    print("Instanciando resultados de BLAST...")
+    # Registro de etapas completadas (ver 'manifest.StageManifest'). Los
+    # resultados de cada etapa se guardan en la caché, y se reutilizan en
+    # cualquier proyecto con los mismos inputs y parámetros.
+    stages = manifest.StageManifest(estruct_dir, resume, cache_budget > 0)
     Protein_class = blastp.Protein
-    blast_results = blastp.parse_blast_results(estruct_dir, Protein_class)
-
-    # Crea un fichero multifasta con los resultados del blast para cada query.
-    print("Construyendo multifasta para MUSCLE...")
-    blastp.build_multifasta_for_muscle(estruct_dir, blast_results, Protein_class)
 
-    # Hace un alineamiento múltiple sobre cada uno de los multifasta del paso
-    # anterior.
-    print("Haciendo alineamiento múltiple...")
-    muscle.multi_align(estruct_dir)
-    aligned_queries = muscle.parse_alignment(estruct_dir, blast_results)
+    # Parsea los fichero de input y extrae secuencias, etc. Los genomas y los
+    # queries son etapas distintas, para compartir los genomas procesados
+    # entre proyectos con distintos queries.
+    genomes_params = {"genomes": cache.hash_files(cache.list_files(subjects_directory)),
+                      "gb_parser": gb_parser, "dedup": dedup}
+    genomes_outputs = [("data", name) for name in
+                       ("genomes_multifasta.fa", "genomes_index.pkl",
+                        "genomes_annotations.pkl", "raw_GBs")]
+    if dedup:
+        genomes_outputs.append(("data", "genomes_members.pkl"))
+    if stages.skip("genomes", genomes_params, genomes_outputs):
+        seq_store = parse_input.load_sequence_store(estruct_dir.file_in_data_dir("genomes_index.pkl"))
+    else:
+        print("Procesando genomas...")
+        seq_store = parse_input.make_genomes_multifasta(subjects_directory, estruct_dir, workers, gb_parser, dedup)
+        # parse_input.store_GBs_copies(subjects_directory, estruct_dir)
+        stages.complete()
+    members = parse_input.load_members(estruct_dir)
+
+    queries_outputs = [("data", "queries.fa"), ("data", "queries_index.pkl")]
+    if stages.skip("queries", {"queries": cache.hash_file(queries_file)}, queries_outputs):
+        query_store = parse_input.load_sequence_store(estruct_dir.file_in_data_dir("queries_index.pkl"))
+    else:
+        print("Procesando queries...")
+        query_store = parse_input.preprocess_queries(queries_file, estruct_dir)
+        stages.complete()
+
+    blast_params = {"evalue": eval_threshold, "coverage": cov_threshold,
+                    "ident": ident_threshold, "prefilter": prefilter_seeds,
+                    "prefilter_report": prefilter_report}
+    blast_outputs = [("data", "blast_hits.pkl"), ("data", "checkpoints/blast.pkl"),
+                     ("results", "blast_results.tsv"),
+                     ("results", "filtered_blast_results.tsv")]
+    if prefilter_seeds is not None:
+        blast_outputs.append(("data", "prefiltered_multifasta.fa"))
+        if prefilter_report:
+            blast_outputs += [("results", "unfiltered_blast_results.tsv"),
+                              ("results", "prefilter_report.txt")]
+    # Los multifasta y alineamientos sólo se guardan con '--export-alignments'.
+    align_params = {"max_aligned": max_aligned, "export": export_alignments}
+    align_outputs = [("data", "checkpoints/align.pkl")]
+    if export_alignments:
+        align_outputs += [("results", "unaligned_matches"), ("results", "aligned_matches")]
+    if max_aligned:
+        align_outputs.append(("results", "representatives"))
+    tree_outputs = [("results", "trees_nw"), ("results", "trees_plot")]
+
+    # Con '--pipeline', el BLAST, el alineamiento, el árbol y la búsqueda de
+    # dominios se hacen a la vez (ver 'scheduler').
+    pipelined = None
+    if stages.skip("blast", blast_params, blast_outputs):
+        blast_results, = saveproject.load_checkpoint(estruct_dir, "blast", Protein_class)
+    else:
+        # Construye (o recupera de la caché) la base de datos de BLAST.
+        print("Preparando base de datos de BLAST...")
+        db_path = blastp.make_blast_db(estruct_dir)
+
+        search_db_path = db_path
+        dbsize = None
+        if prefilter_seeds is not None:
+            # Sólo se buscan las proteínas que comparten semillas con los queries.
+            print("Prefiltrando secuencias...")
+            kept, total, total_length = prefilter.select_subjects(seq_store, query_store, prefilter_seeds)
+            subset_path = prefilter.write_subset(estruct_dir, seq_store, kept)
+            print("{} de {} secuencias superan el prefiltro.".format(len(kept), total))
+            if kept:
+                search_db_path = blastp.make_subset_db(estruct_dir, subset_path)
+                dbsize = total_length
+            else:
+                # makeblastdb no acepta un multifasta vacío.
+                print("Ninguna secuencia supera el prefiltro: se buscan todas.")
+
+        # El BLAST se hace con umbrales permisivos, y todos sus resultados se
+        # guardan, para poder volver a filtrarlos después ('--refilter').
+        hits = blastp.HitTable()
+        if pipeline:
+            # Las etapas siguientes se ejecutan a la vez que el BLAST, salvo
+            # las que se puedan recuperar de la caché.
+            run_align = not stages.skip("align", align_params, align_outputs)
+            run_tree = not stages.skip("tree", {}, tree_outputs)
+            dict_pattern, dict_names = prosite.create_prosite_dict(exclude=exclude)
+            print("Haciendo BLAST, alineamiento múltiple y búsqueda de dominios de cada query...")
+            pipelined = scheduler.run_pipeline(estruct_dir, Protein_class, seq_store, query_store,
+                                               search_db_path, eval_threshold, cov_threshold,
+                                               ident_threshold, dict_pattern, members, hits,
+                                               max_aligned, run_align, run_tree, jobs, workers,
+                                               num_threads, dbsize, export_alignments)
+            blast_results = pipelined.proteins
+        else:
+            # Hace el BLAST y, a medida que llegan los resultados, los filtra y
+            # almacena cada uno en una instancia de la clase Protein.
+            print("Haciendo BLAST...")
+            blast_lines = blastp.blast_it(estruct_dir,
+                                          max(eval_threshold, blastp.PERMISSIVE_EVALUE),
+                                          min(cov_threshold, blastp.PERMISSIVE_COVERAGE),
+                                          search_db_path, num_threads, dbsize)
+            blast_results = blastp.parse_blast_results(estruct_dir, Protein_class, seq_store, blast_lines,
+                                                       eval_threshold, cov_threshold, ident_threshold, members, hits)
+        hits.save(estruct_dir.file_in_data_dir("blast_hits.pkl"))
+
+        if prefilter_seeds is not None and prefilter_report:
+            # BLAST sobre todas las secuencias, sólo para medir el recall.
+            print("Haciendo BLAST sin prefiltro...")
+            unfiltered_lines = blastp.blast_it(estruct_dir, eval_threshold, cov_threshold, db_path, num_threads)
+            expected = {(campos[0], campos[1]) for campos in blastp.filter_blast_lines(
+                    unfiltered_lines, eval_threshold, cov_threshold, ident_threshold,
+                    estruct_dir.file_in_results_dir("unfiltered_blast_results.tsv"))}
+            obtained = {(protein.query_id, protein.subject_id) for protein in blast_results}
+            recall = prefilter.recall_report(estruct_dir, expected, obtained, kept, total)
+            print("Recall del prefiltro: {:.2%}".format(recall))
+
+        saveproject.save_checkpoint(estruct_dir, "blast", (blast_results,), Protein_class)
+        stages.complete("blast")
+
+    if pipelined is not None:
+        if pipelined.aligned:
+            aligned_queries = pipelined.queries
+            saveproject.save_checkpoint(estruct_dir, "align", (blast_results, aligned_queries), Protein_class)
+            stages.complete("align")
+        else:
+            blast_results, aligned_queries = saveproject.load_checkpoint(estruct_dir, "align", Protein_class)
+        if run_tree and not pipelined.trees:
+            # Alineamiento recuperado de la caché: el árbol se hace ahora.
+            muscle.build_tree(estruct_dir, alignments=muscle.stored_alignments(
+                    estruct_dir, aligned_queries, blast_results))
+        if run_tree:
+            muscle.plot_tree(estruct_dir)
+            stages.complete("tree")
+    elif stages.skip("align", align_params, align_outputs):
+        blast_results, aligned_queries = saveproject.load_checkpoint(estruct_dir, "align", Protein_class)
+    else:
+        # Crea un multifasta con los resultados del blast para cada query.
+        print("Construyendo multifasta para MUSCLE...")
+        fastas = blastp.build_multifasta_for_muscle(estruct_dir, blast_results, Protein_class, query_store,
+                                                    max_aligned, export=export_alignments)
+
+        # Hace un alineamiento múltiple sobre cada uno de los multifasta del paso
+        # anterior.
+        print("Haciendo alineamiento múltiple...")
+        alignments = muscle.multi_align(estruct_dir, fastas, jobs, export_alignments)
+        aligned_queries = muscle.parse_alignment(estruct_dir, blast_results, alignments=alignments)
+
+        saveproject.save_checkpoint(estruct_dir, "align", (blast_results, aligned_queries), Protein_class)
+        stages.complete()
+
+    if pipelined is None and not stages.skip("tree", {}, tree_outputs):
+        # Construye árbol filogenético en formato newick.
+        print("Construyendo árbol filogenético...")
+        muscle.build_tree(estruct_dir, alignments=muscle.stored_alignments(
+                estruct_dir, aligned_queries, blast_results))
+
+        # Representa cada árbol filogenético en un fichero .pdf.
+        muscle.plot_tree(estruct_dir)
+        stages.complete()
+
+    settings = {"evalue": eval_threshold, "coverage": cov_threshold,
+                "ident": ident_threshold, "exclude": exclude,
+                "max_aligned": max_aligned, "export_alignments": export_alignments}
+    domains_outputs = [("results", "protein_domains"), ("results", "project.bapj")]
+    # Los dominios dependen también de la base de datos de PROSITE.
+    domains_params = {"exclude": exclude, "prosite": prosite.bank_signature()}
+    if stages.skip("domains", domains_params, domains_outputs):
+        # El estado al final de esta etapa es el del fichero del proyecto.
+        objects = saveproject.open_project(estruct_dir.file_in_results_dir("project.bapj"))
+        blast_results = objects[1]
+        aligned_queries = objects[2]
+        Protein_class.import_queries_list(objects[3])
+        dict_names = objects[4]
+        Protein_class.import_accessions_list(objects[5])
+        Protein_class.import_sequences_list(objects[6])
+        if objects[0].rel_results_path != estruct_dir.rel_results_path:
+            # Proyecto recuperado de la caché: se guarda con sus directorios.
+            saveproject.save(estruct_dir, blast_results, aligned_queries, Protein_class, dict_names, settings)
+    else:
+        # Parsea la base de datos de prosite (prosite.dat) y genera dos diccionarios que
+        # relacionan los patrones con los números de accesión y nombre de los dominios.
+        print("Parseando base de datos PROSITE...")
+        dict_pattern, dict_names = prosite.create_prosite_dict(exclude=exclude)
+
+        # Busca dominios conservados en los resultados del blast (salvo los
+        # que ya se hayan buscado con '--pipeline').
+        print("Buscando dominios conservados...")
+        found = pipelined.domains if pipelined is not None else None
+        prosite.search_domains(estruct_dir, blast_results, Protein_class, dict_pattern, workers, found)
+
+        # Los dominios de los queries sólo se necesitan para los plots.
+        prosite.search_query_domains(aligned_queries, dict_pattern, workers, found)
+
+        print("Ubicando dominios conservados en el alineamiento...")
+        plot.map_aligned_domains(blast_results, aligned_queries, threshold=4)
+
+        print("Construyendo plot...")
+        plot.analyze_alignment(blast_results, aligned_queries)
+
+        # Recupera los miembros de los grupos de secuencias idénticas, con los
+        # resultados de su representante.
+        if members:
+            blast_results = blastp.expand_members(blast_results, members)
+
+        # Genera un fichero output para cada query con un resumen de los dominios
+        # encontrados
+        prosite.output_domains(estruct_dir, blast_results, Protein_class, dict_names)
+
+        print("Guardando proyecto...")
+        saveproject.save(estruct_dir, blast_results, aligned_queries, Protein_class, dict_names, settings)
+        stages.complete()
+
+    if not stages.skip("plots", {}, [("results", "plots")]):
+        print("Generando plots...")
+        plot.generate_static_graphs(estruct_dir, blast_results, aligned_queries, Protein_class)
+        stages.complete()
+
+    # Elimina las entradas de la caché usadas hace más tiempo, si ocupa más
+    # de lo indicado con '--cache-budget'. Con 0 no se usa la caché de
+    # etapas, y no se elimina nada: la caché de proteomas y bases de datos
+    # se sigue usando, y vaciarla obligaría a reconstruirla en cada ejecución.
+    if cache_budget > 0:
+        freed = cache.evict(cache_budget)
+        if freed:
+            print("Liberados {:.1f} MB de la caché.".format(freed / (1 << 20)))
 
+if opening == True:
+    Protein_class = blastp.Protein
+    objects = saveproject.open_project(open_path)
+    estruct_dir = objects[0]
+    blast_results = objects[1]
+    aligned_queries = objects[2]
+    Protein_class.import_queries_list(objects[3])
+    dict_names = objects[4]
+    if len(objects) > 5:
+        Protein_class.import_accessions_list(objects[5])
+        Protein_class.import_sequences_list(objects[6])
+    # Los proyectos anteriores no guardan las tablas de accessions y
+    # secuencias: se reconstruyen al cargar las instancias de Protein (ver
+    # 'Protein.__setstate__').
+
+if refiltering == True:
+    # Vuelve a filtrar los resultados del BLAST guardados en el proyecto, y
+    # sólo rehace lo que depende de los resultados que cambian.
+    settings = objects[7] if len(objects) > 7 else None
+    if settings is None or not os.path.exists(estruct_dir.file_in_data_dir("blast_hits.pkl")):
+        print("ERROR: El proyecto no contiene los resultados del BLAST sin filtrar.")
+        sys.exit(2)
 
-    # Construye árbol filogenético en formato newick.
-    print("Construyendo árbol filogenético...")
-    muscle.build_tree(estruct_dir)
-
-    # Representa cada árbol filogenético en un fichero .pdf.
-    muscle.plot_tree(estruct_dir)
+    # Los umbrales que no se indiquen son los del proyecto.
+    given_options = [o for o, a in opts]
+    if "--eval" not in given_options:
+        eval_threshold = settings["evalue"]
+    if "--cov" not in given_options:
+        cov_threshold = settings["coverage"]
+    if "--ident" not in given_options:
+        ident_threshold = settings["ident"]
+    if "--max-aligned" not in given_options:
+        max_aligned = settings["max_aligned"]
+    if "--export-alignments" not in given_options:
+        # Los proyectos anteriores siempre guardaban los alineamientos.
+        export_alignments = settings.get("export_alignments", True)
+    exclude = settings["exclude"]
+
+    if eval_threshold > blastp.PERMISSIVE_EVALUE or cov_threshold < blastp.PERMISSIVE_COVERAGE:
+        print("AVISO: El BLAST se hizo con e-value {} y cobertura {}; no hay resultados más allá.".format(
+                blastp.PERMISSIVE_EVALUE, blastp.PERMISSIVE_COVERAGE))
+
+    print("Filtrando de nuevo los resultados del BLAST...")
+    hits = blastp.load_hit_table(estruct_dir)
+    if len(hits) and len(hits.campos(0)) < len(blastp.BLAST_FIELDS.split()) - 1:
+        # Proyectos anteriores a 'qcovhsp' (ver 'blastp.BLAST_FIELDS').
+        print("AVISO: El proyecto no guarda la cobertura de cada HSP; '--cov' se aplica a la de cada subject.")
+    members = parse_input.load_members(estruct_dir)
+    member_ids = {member for group in members.values() for member in group}
+    seq_store = parse_input.load_sequence_store(estruct_dir.file_in_data_dir('genomes_index.pkl'))
+    previous_queries = list(Protein_class.queries)
+
+    # Los miembros de grupos de secuencias idénticas se vuelven a añadir al
+    # final.
+    base_results = [protein for protein in blast_results if protein.subject_id not in member_ids]
+    base_results, added, added_queries, removed_queries = blastp.refilter_results(
+            estruct_dir, hits, base_results, Protein_class, seq_store,
+            eval_threshold, cov_threshold, ident_threshold, members)
+    print("{} resultados ({} nuevos).".format(len(base_results), len(added)))
+
+    for query in previous_queries:
+        if query not in Protein_class.queries:
+            dirs.elimina_resultados_query(estruct_dir, query)
+
+    # Los queries con resultados nuevos (o agrupados, ver '--max-aligned') se
+    # vuelven a alinear; en los que sólo pierden resultados, basta con
+    # quitarlos del alineamiento.
+    realign = set(added_queries)
+    for query in removed_queries:
+        matches = [protein for protein in base_results if protein.query_id == query]
+        if (any(protein.representative is not None for protein in matches)
+                or (max_aligned and len(matches) > max_aligned)):
+            realign.add(query)
+    subset = (removed_queries - realign) & set(Protein_class.queries)
+    realign &= set(Protein_class.queries)
+    changed = realign | subset
 
-    # Parsea la base de datos de prosite (prosite.dat) y genera dos diccionarios que
-    # relacionan los patrones con los números de accesión y nombre de los dominios.
-    print("Parseando base de datos PROSITE...")
     dict_pattern, dict_names = prosite.create_prosite_dict(exclude=exclude)
-
-    # Busca dominios conservados en los resultados del blast.
     print("Buscando dominios conservados...")
-    prosite.search_domains(estruct_dir, blast_results, Protein_class, dict_pattern)
+    prosite.search_domains(estruct_dir, added, Protein_class, dict_pattern, workers)
+
+    previous_aligned = {query.id: query for query in aligned_queries}
+    changed_queries = []
+
+    if realign:
+        print("Haciendo alineamiento múltiple...")
+        for protein in base_results:
+            if protein.query_id in realign:
+                protein.reset_alignment()
+        query_store = parse_input.load_queries(estruct_dir)
+        fastas = blastp.build_multifasta_for_muscle(estruct_dir, base_results, Protein_class, query_store,
+                                                    max_aligned, realign, export_alignments)
+        alignments = muscle.multi_align(estruct_dir, fastas, jobs, export_alignments)
+        realigned_queries = muscle.parse_alignment(estruct_dir, base_results, realign, alignments)
+        prosite.search_query_domains(realigned_queries, dict_pattern, workers)
+        changed_queries += realigned_queries
+
+    for query in subset:
+        changed_queries.append(muscle.subset_alignment(
+                estruct_dir, previous_aligned[query],
+                [protein for protein in base_results if protein.query_id == query],
+                export_alignments))
 
-    # Genera un fichero output para cada query con un resumen de los dominios
-    # encontrados
-    prosite.output_domains(estruct_dir, blast_results, Protein_class, dict_names)
+    print("Construyendo árbol filogenético...")
+    muscle.build_tree(estruct_dir, queries=changed, alignments=muscle.stored_alignments(
+            estruct_dir, changed_queries, base_results))
+    muscle.plot_tree(estruct_dir, changed)
 
+    changed_results = [protein for protein in base_results if protein.query_id in changed]
+    plot.map_aligned_domains(changed_results, changed_queries, threshold=4)
+    plot.analyze_alignment(changed_results, changed_queries)
 
-    print("Ubicando dominios conservados en el alineamiento...")
-    plot.search_aligned_domains(dict_pattern, blast_results, aligned_queries, threshold=4)
+    changed_aligned = {query.id: query for query in changed_queries}
+    aligned_queries = [changed_aligned.get(query, previous_aligned.get(query))
+                       for query in Protein_class.queries]
 
-    print("Construyendo plot...")
-    plot.analyze_alignment(blast_results)
-    plot.analyze_alignment(aligned_queries)
+    blast_results = base_results
+    if members:
+        blast_results = blastp.expand_members(base_results, members)
+
+    prosite.output_domains(estruct_dir, blast_results, Protein_class, dict_names, changed)
 
     print("Guardando proyecto...")
-    saveproject.save(estruct_dir, blast_results, aligned_queries, Protein_class, dict_names)
+    settings = {"evalue": eval_threshold, "coverage": cov_threshold,
+                "ident": ident_threshold, "exclude": exclude,
+                "max_aligned": max_aligned, "export_alignments": export_alignments}
+    saveproject.save(estruct_dir, blast_results, aligned_queries, Protein_class, dict_names, settings)
 
     print("Generando plots...")
-    plot.generate_static_graphs(estruct_dir, blast_results, aligned_queries, Protein_class)
-
-if opening == True:
-    Protein_class = blastp.Protein
-    objects = saveproject.open_project(open_path)
-    estruct_dir = objects[0]
-    blast_results = objects[1]
-    aligned_queries = objects[2]
-    Protein_class.import_queries_list(objects[3])
-    dict_names = objects[4]
+    plot.generate_static_graphs(estruct_dir, blast_results, aligned_queries, Protein_class, changed)
 
 
 print("Abriendo menú interactivo...")
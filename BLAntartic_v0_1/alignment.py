@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+#
+# BLAntarctic v0.1 - 'alignment' module
+#
+# Alineamientos múltiples como matrices de NumPy (una fila por secuencia y
+# una columna por posición) y los cálculos sobre ellas: regiones sin gaps de
+# cada secuencia y estadísticas de cada columna.
+#
+
+import numpy as np
+
+import blastp
+
+
+GAP = ord("-")
+
+
+def encode_alignment(sequences):
+    """
+    Codifica un alineamiento (lista de secuencias de igual longitud) como una
+    matriz de NumPy (uint8), con una fila por secuencia y una columna por
+    posición del alineamiento.
+    """
+    return(np.array([np.frombuffer(blastp.alignment_bytes(seq).upper(), dtype=np.uint8)
+                     for seq in sequences], dtype=np.uint8).reshape(len(sequences), -1))
+
+
+def residue_mask(matrix):
+    """
+    Indica qué posiciones de un alineamiento codificado ('matrix', ver
+    'encode_alignment') son aminoácidos (letras).
+    """
+    return((matrix >= ord("A")) & (matrix <= ord("Z")))
+
+
+def non_gapped_runs(matrix):
+    """
+    Devuelve, para cada fila del alineamiento codificado 'matrix', un array
+    (n, 2) con el inicio y el final (no incluido) de cada región de
+    aminoácidos consecutivos, es decir, sin gaps.
+    """
+    rows, columns = matrix.shape
+    # Con una columna vacía a cada lado, las regiones empiezan donde la
+    # diferencia entre columnas consecutivas es 1 y terminan donde es -1.
+    padded = np.zeros((rows, columns + 2), dtype=np.int8)
+    padded[:, 1:-1] = residue_mask(matrix)
+    edges = np.diff(padded, axis=1)
+
+    # 'nonzero' recorre la matriz por filas, así que los inicios y los finales
+    # de cada fila quedan emparejados y en orden.
+    owners, starts = np.nonzero(edges == 1)
+    ends = np.nonzero(edges == -1)[1]
+    runs = np.stack((starts, ends), axis=1)
+    return(np.split(runs, np.cumsum(np.bincount(owners, minlength=rows))[:-1]))
+
+
+def column_statistics(matrix, query_row):
+    """
+    Calcula, para cada columna del alineamiento codificado 'matrix', una
+    tupla de arrays (occupancy, consensus, identity):
+
+    - 'occupancy': proporción de secuencias con un aminoácido (no un gap).
+    - 'consensus': el aminoácido más frecuente (en caso de empate, el primero
+      por orden alfabético), o un gap si no hay ninguno. En bytes.
+    - 'identity': proporción de las demás secuencias con el mismo aminoácido
+      que el query (fila 'query_row'). Es 0 en las columnas en las que el
+      query tiene un gap.
+    """
+    rows, columns = matrix.shape
+    residues = residue_mask(matrix)
+    occupancy = residues.mean(axis=0)
+
+    # Frecuencia de cada letra (1-26, 0 para los gaps) en cada columna.
+    codes = np.where(residues, matrix - (ord("A") - 1), 0).astype(np.int64)
+    counts = np.bincount((codes * columns + np.arange(columns)).ravel(),
+                         minlength=27 * columns).reshape(27, columns)[1:]
+    consensus = np.where(counts.max(axis=0) > 0, counts.argmax(axis=0) + ord("A"), GAP)
+
+    same = (matrix == matrix[query_row]) & residues & residues[query_row]
+    same[query_row] = False
+    identity = same.sum(axis=0) / max(rows - 1, 1)
+
+    return(occupancy, consensus.astype(np.uint8).tobytes(), identity)
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+#
+# BLAntarctic v0.1 - benchmark de la búsqueda de dominios
+#
+# Compara la búsqueda de dominios original (todas las expresiones regulares
+# sobre todas las secuencias) con 'prosite.DomainScanner', y comprueba que
+# ambos dan exactamente los mismos resultados.
+#
+# USO:
+#     python benchmark_domains.py secuencias.fa [--exclude]
+#
+# 'secuencias.fa' puede ser cualquier multifasta de matches, por ejemplo los
+# ficheros de 'unaligned_matches' de un proyecto (con '--export-alignments'),
+# o el 'genomes_multifasta.fa' de la carpeta de datos. Debe ejecutarse desde
+# la carpeta del paquete (junto a 'prosite.dat').
+#
+
+import re
+import sys
+import time
+
+from Bio import SeqIO
+
+import prosite
+
+
+def naive_scan(sequences, dict_pattern):
+    """
+    Búsqueda original: cada patrón se evalúa sobre cada secuencia.
+    """
+    results = []
+    for sequence in sequences:
+        found = []
+        for pattern in list(dict_pattern.keys()):
+            for match in re.finditer(pattern, sequence):
+                found.append((dict_pattern[pattern], match.start(), match.end()))
+        results.append(found)
+    return(results)
+
+
+def engine_scan(sequences, dict_pattern):
+    """
+    Búsqueda con 'prosite.DomainScanner'.
+    """
+    scanner = prosite.DomainScanner(dict_pattern)
+    return([scanner.scan(sequence) for sequence in sequences])
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("USO: python benchmark_domains.py secuencias.fa [--exclude]")
+        sys.exit(2)
+
+    with open(sys.argv[1], 'r') as input_handle:
+        sequences = [str(record.seq).replace("-", "")
+                     for record in SeqIO.parse(input_handle, "fasta")]
+
+    dict_pattern, dict_names = prosite.create_prosite_dict(
+            exclude="--exclude" in sys.argv)
+
+    print("{} secuencias, {} patrones.".format(len(sequences), len(dict_pattern)))
+
+    start = time.perf_counter()
+    expected = naive_scan(sequences, dict_pattern)
+    naive_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    obtained = engine_scan(sequences, dict_pattern)
+    engine_time = time.perf_counter() - start
+
+    if obtained != expected:
+        print("ERROR: los resultados no coinciden.")
+        sys.exit(1)
+
+    print("Dominios encontrados: {}".format(sum(len(found) for found in expected)))
+    print("Búsqueda original:  {:.2f} s".format(naive_time))
+    print("DomainScanner:      {:.2f} s".format(engine_time))
+    print("Aceleración:        {:.1f}x".format(naive_time / engine_time))
@@ -5,48 +5,334 @@
 # output.
 #
 
-from Bio.Blast.Applications import NcbiblastpCommandline
 import os
+import contextlib
+import pickle
+import tempfile
+from subprocess import PIPE
+from subprocess import Popen
+from subprocess import CalledProcessError
+from array import array
 
 from Bio import Seq
 from Bio import SeqIO
 
-def blast_it(estruct_dir, evalue, coverage):
+import numpy as np
+
+import cache
+import cluster
+
+def run_makeblastdb(input_file, db_path):
+    """
+    Construye con makeblastdb una base de datos de proteínas ('db_path') a
+    partir de un multifasta. Si makeblastdb falla, lanza 'CalledProcessError'
+    con su stderr (como 'blast_it').
+    """
+    command = ["makeblastdb",
+               "-in", input_file,
+               "-dbtype", "prot",
+               "-parse_seqids",
+               "-out", db_path]
+    process = Popen(command, stdout=PIPE, stderr=PIPE, universal_newlines=True)
+    stdout, stderr = process.communicate()
+    if process.returncode != 0:
+        raise CalledProcessError(process.returncode, command, output=stdout, stderr=stderr)
+
+
+def make_blast_db(estruct_dir):
+    """
+    Construye (con makeblastdb) una base de datos de BLAST a partir del
+    multifasta de genomas.
+
+    La base de datos se guarda en la caché compartida, bajo el hash del
+    multifasta, de forma que si otro proyecto tiene las mismas secuencias
+    con los mismos ids no hace falta volver a construirla. Devuelve el path
+    (prefijo) de la base de datos.
+
+    El hash es el del multifasta escrito, y no el de los GeneBank: con
+    '--dedup', los ids de los representantes dependen del orden de los
+    ficheros, y los proteomas de cada '--gb-parser' pueden diferir.
+    """
+    multifasta_path = estruct_dir.file_in_data_dir('genomes_multifasta.fa')
+    db_dir = cache.cache_dir("blastdb", cache.hash_file(multifasta_path))
+    db_path = "{}/genomes".format(db_dir)
+
+    # El fichero 'done' sólo se crea cuando makeblastdb ha terminado
+    # correctamente: evita reutilizar bases de datos incompletas.
+    if os.path.exists(db_dir + "/done"):
+        cache.touch(db_dir)
+        return(db_path)
+
+    run_makeblastdb(multifasta_path, db_path)
+    open(db_dir + "/done", 'w').close()
+
+    return(db_path)
+
+
+def make_subset_db(estruct_dir, input_file):
+    """
+    Construye una base de datos de BLAST, en la carpeta de datos del
+    proyecto, a partir de un multifasta con parte de las secuencias de los
+    genomas (ver 'prefilter'). No se guarda en la caché, porque depende de
+    los queries. Devuelve el path (prefijo) de la base de datos.
+    """
+    db_path = estruct_dir.file_in_data_dir("prefiltered_db")
+    run_makeblastdb(input_file, db_path)
+    return(db_path)
+
+
+# Campos de la salida tabular de blastp. 'qcovs' es la cobertura del query
+# por el conjunto de HSPs de cada subject, y 'qcovhsp' (al final, para no
+# mover los demás) la de cada HSP, que es a la que se aplica '--cov', como
+# hacía BLAST con '-qcov_hsp_perc'.
+BLAST_FIELDS = "6 qseqid sseqid sseq evalue qcovs pident qstart qend qcovhsp"
+
+# Umbrales con los que se hace el BLAST. Son más permisivos que los que
+# se indiquen al programa, para poder volver a filtrar los resultados con
+# otros umbrales sin repetir el BLAST (ver 'HitTable').
+PERMISSIVE_EVALUE = 1.0
+PERMISSIVE_COVERAGE = 0
+
+
+def blast_command(query_path, db_path, evalue, coverage, num_threads=1, dbsize=None):
+    """
+    Devuelve el comando de blastp para buscar las secuencias del fichero
+    'query_path' ("-" para leerlas de stdin) en la base de datos 'db_path'
+    (ver 'blast_it').
+    """
+    command = ["blastp",
+               "-query", query_path,
+               "-db", db_path,
+               "-outfmt", BLAST_FIELDS,
+               "-evalue", str(evalue),
+               "-qcov_hsp_perc", str(coverage),
+               "-num_threads", str(num_threads)]
+    if dbsize is not None:
+        command += ["-dbsize", str(dbsize)]
+    return(command)
+
+
+def blast_it(estruct_dir, evalue, coverage, db_path, num_threads=1, dbsize=None):
     """blastp
 
-    Sobre el conjunto de subjects que se indique, se hace un blastp de la
-    secuencia query. Se genera un fichero de salida con un nombre contruido a
-    partir del argumento 'nombre_proyecto'.
+    Sobre la base de datos de subjects que se indique ('db_path', ver
+    'make_blast_db'), se hace un blastp de las secuencias query, utilizando
+    'num_threads' hilos. Genera las líneas de la salida tabular de blastp a
+    medida que se producen (ver 'filter_blast_lines').
+
+    'dbsize' permite calcular los e-values como si la base de datos tuviera
+    ese número de residuos (con el prefiltro, el de todos los genomas), para
+    que no cambien al buscar sólo en una parte de las secuencias.
+    """
+
+    command = blast_command(estruct_dir.file_in_data_dir('queries.fa'), db_path,
+                            evalue, coverage, num_threads, dbsize)
+
+    # stderr va a un fichero temporal: si se leyera de un pipe, blastp se
+    # podría bloquear al llenarlo mientras se lee stdout.
+    with tempfile.TemporaryFile() as stderr_file:
+        process = Popen(command, stdout=PIPE, stderr=stderr_file, universal_newlines=True)
+        with process.stdout:
+            for line in process.stdout:
+                yield(line)
+
+        if process.wait() != 0:
+            stderr_file.seek(0)
+            raise CalledProcessError(process.returncode, command,
+                                     stderr=stderr_file.read().decode(errors="replace"))
+
+
+def write_hit_line(handle, line, members=None):
+    """
+    Escribe una línea de resultados del BLAST y, si el subject es el
+    representante de un grupo de secuencias idénticas (ver
+    'parse_input.load_members'), una línea para cada miembro, con su id.
+    """
+    handle.write(line)
+    if members:
+        campos = line.rstrip("\n").split("\t")
+        for member in members.get(campos[1], ()):
+            handle.write("\t".join(campos[:1] + [member] + campos[2:]) + "\n")
+
+
+def passes_thresholds(campos, evalue, coverage, ident):
     """
+    Indica si un resultado del BLAST (sus campos, ver 'BLAST_FIELDS') supera
+    los umbrales de e-value, cobertura (por HSP) e identidad.
+    """
+    return(float(campos[3]) <= evalue and float(campos[8]) >= coverage
+           and float(campos[5]) > ident)
+
+
+def filter_blast_lines(lines, evalue, coverage, ident, raw_path, filtered_path=None,
+                       members=None, hits=None):
+    """
+    Filtra las líneas de la salida de blastp (ver 'blast_it') y genera los
+    campos de las que superan los umbrales de e-value, cobertura e identidad.
+
+    Todas las líneas se copian en 'raw_path', y las que superan los umbrales
+    en 'filtered_path' (si se indica), sólo como ficheros de salida: no se
+    vuelven a leer. Con 'members' (ver 'parse_input.load_members'), en
+    'filtered_path' se añade también una línea para cada miembro del grupo
+    de secuencias idénticas del subject, con su id.
 
-    subject = estruct_dir.file_in_data_dir('genomes_multifasta.fa')
-    query = estruct_dir.file_in_data_dir('queries.fa')
-    out = estruct_dir.file_in_results_dir("blast_results.tsv")
+    Si se indica 'hits' (un 'HitTable'), se guardan en él todas las líneas,
+    superen o no los umbrales.
+    """
+    with contextlib.ExitStack() as stack:
+        raw = stack.enter_context(open(raw_path, 'w'))
+        filtered = None
+        if filtered_path is not None:
+            filtered = stack.enter_context(open(filtered_path, 'w'))
+
+        for line in lines:
+            raw.write(line)
+            campos = line.rstrip("\n").split("\t")
+            if hits is not None:
+                hits.add(line, campos)
+            if not passes_thresholds(campos, evalue, coverage, ident):
+                continue
+
+            if filtered is not None:
+                write_hit_line(filtered, line, members)
 
-    blastp_cline = NcbiblastpCommandline(
-            query = query,
-            subject = subject,
-            outfmt = '"6 qseqid sseqid sseq evalue qcovs pident qstart qend"',
-            out = out,
-            evalue = evalue,
-            qcov_hsp_perc = coverage)
+            yield(campos)
 
-    stdout, stderr = blastp_cline()
 
-def filter_ident(estruct_dir, ident):
+class HitTable:
+    """
+    Tabla con todos los resultados del BLAST, obtenidos con umbrales
+    permisivos (ver 'PERMISSIVE_EVALUE'), que se guarda en la carpeta de
+    datos ('blast_hits.pkl'). Permite filtrarlos con otros umbrales sin
+    repetir el BLAST (ver 'select' y 'refilter_results').
+
+    El e-value, la cobertura (por HSP, ver 'BLAST_FIELDS') y la identidad
+    de cada resultado se guardan en arrays, para poder filtrar todos a la
+    vez.
+    """
+
+    def __init__(self):
+        self.lines = []
+        self.evalue = array('d')
+        self.coverage = array('d')
+        self.ident = array('d')
+
+    def add(self, line, campos):
+        """
+        Añade un resultado: la línea de la salida de blastp y sus campos.
+        """
+        self.lines.append(line)
+        self.evalue.append(float(campos[3]))
+        self.coverage.append(float(campos[8]))
+        self.ident.append(float(campos[5]))
+
+    def __len__(self):
+        return len(self.lines)
+
+    def select(self, evalue, coverage, ident):
+        """
+        Devuelve la posición (en orden) de los resultados que superan los
+        umbrales, con los mismos criterios que 'filter_blast_lines'.
+        """
+        passed = ((np.frombuffer(self.evalue, dtype=np.float64) <= evalue)
+                  & (np.frombuffer(self.coverage, dtype=np.float64) >= coverage)
+                  & (np.frombuffer(self.ident, dtype=np.float64) > ident))
+        return(np.nonzero(passed)[0].tolist())
 
-    input = estruct_dir.file_in_results_dir("blast_results.tsv")
-    output = estruct_dir.file_in_results_dir("filtered_blast_results.tsv")
+    def campos(self, row):
+        return self.lines[row].rstrip("\n").split("\t")
+
+    def save(self, path):
+        with open(path, 'wb') as output:
+            pickle.dump(self, output, pickle.HIGHEST_PROTOCOL)
+
+
+def load_hit_table(estruct_dir):
+    """
+    Recupera la tabla de resultados del BLAST guardada en la carpeta de
+    datos (ver 'HitTable').
+    """
+    with open(estruct_dir.file_in_data_dir("blast_hits.pkl"), 'rb') as input:
+        return(pickle.load(input))
+
+
+class InternTable:
+    """
+    Tabla de valores únicos (accessions, secuencias...). Cada valor se guarda
+    una única vez, y se identifica por su posición en la tabla.
+    """
+
+    def __init__(self, values=()):
+        self.values = []
+        self.ids = {}
+        for value in values:
+            self.add(value)
+
+    def add(self, value):
+        """
+        Devuelve la posición del valor en la tabla, añadiéndolo si no está.
+        """
+        try:
+            return self.ids[value]
+        except KeyError:
+            self.ids[value] = len(self.values)
+            self.values.append(value)
+            return self.ids[value]
+
+    def __getitem__(self, value_id):
+        return self.values[value_id]
+
+    def __len__(self):
+        return len(self.values)
+
+
+def alignment_bytes(aligned_seq):
+    """
+    Devuelve una secuencia alineada en bytes, que es como se guardan (ocupan
+    menos que los objetos 'Seq' o el texto, y se pueden convertir en arrays
+    de NumPy sin copiarlas). Los proyectos anteriores las guardan como texto.
+    """
+    if isinstance(aligned_seq, bytes):
+        return(aligned_seq)
+    return(str(aligned_seq).encode())
 
-    with open(output, 'a') as out:
-        with open(input, 'r') as file:
-            for line in file:
-                split_line = line.split("\t")
-                if float(split_line[5]) > ident:
-                    out.write(line)
 
 class Protein:
+    """
+    Sus instancias almacenan cada resultado del BLAST, y toda la información
+    que se obtiene después sobre él (alineamiento, dominios...).
+
+    Para que proyectos con muchos resultados ocupen poco en memoria, las
+    instancias no tienen '__dict__' (sólo los atributos de '__slots__'), y
+    los dominios y regiones sin gaps se guardan como enteros en arrays
+    planos. Los atributos 'domains', 'aligned_domains' y 'non_gapped' se
+    siguen pudiendo recorrer como listas de tuplas.
+
+    Las secuencias (original y alineada) tampoco se guardan en la instancia,
+    sino en la tabla compartida 'Protein.sequences': si varios queries
+    encuentran la misma proteína, su secuencia se almacena una sola vez. La
+    secuencia alineada se guarda en bytes (ver 'alignment_bytes').
+
+    Si los resultados de un query se agrupan antes del alineamiento (ver
+    'build_multifasta_for_muscle'), 'representative' es el subject id del
+    resultado que se alinea en su lugar; si no, es 'None'.
+    """
+
+    __slots__ = ("index", "query_id", "subject_id", "seq_id",
+                 "evalue", "query_cov", "ident", "range", "aligned_id",
+                 "representative",
+                 "_domains", "_aligned_domains", "_non_gapped")
+
+    # Queries para los que hay resultados, en orden de aparición.
     queries = []
+    _queries_set = set()
+
+    # Accessions de PROSITE. En los arrays de dominios se guarda la posición
+    # del accession en esta tabla.
+    accessions = InternTable()
+
+    # Secuencias de todas las instancias, originales y alineadas.
+    sequences = InternTable()
 
     def __init__(self, idx,
                  query_id,subj_id, subj_seq,
@@ -58,43 +344,92 @@ class Protein:
         self.index = int(idx) # Asigna ID numerico a la instancia.
         self.query_id = query_id
         self.subject_id = subj_id
-        self.subject_seq = subj_seq
+        self.seq_id = Protein.sequences.add(str(subj_seq))
         self.evalue = float(eval)
         self.query_cov = float(query_cov)
         self.ident = float(ident)
         self.range = (qstart, qend)
+        self.aligned_id = -1 # Sin alineamiento.
+        self.representative = None
 
-        # Separa el subject id en locus_tag y especie.
-        split_id = subj_id.split("@")
-        self.subject_accs = str(split_id[0])
-        self.subject_spec = str(split_id[1])
-        self.subject_id_spaced = "{} @ {}".format(
-                self.subject_accs,
-                self.subject_spec)
-
-        # Inicializa estas listas, sobre las cuales se harán appends después.
-        self.domains = []
-        self.aligned_domains = []
-        self.non_gapped = []
+        # Inicializa estos arrays, sobre los cuales se harán appends después.
+        self._domains = array('i')
+        self._aligned_domains = array('i')
+        self._non_gapped = array('i')
 
         # Lleva un registro de todos los queries para los cuales se han
         # guardado resultados.
-        Protein.queries.append(query_id)
-        Protein.temp1 = set(Protein.queries)
-        Protein.queries = list(Protein.temp1)
+        if query_id not in Protein._queries_set:
+            Protein._queries_set.add(query_id)
+            Protein.queries.append(query_id)
+
+    @property
+    def subject_seq(self):
+        return Protein.sequences[self.seq_id]
+
+    @property
+    def aligned_seq(self):
+        if self.aligned_id < 0:
+            return None
+        return Protein.sequences[self.aligned_id]
+
+    # Separa el subject id en locus_tag y especie.
+    @property
+    def subject_accs(self):
+        return self.subject_id.split("@")[0]
+
+    @property
+    def subject_spec(self):
+        return self.subject_id.split("@")[1]
+
+    @property
+    def subject_id_spaced(self):
+        return "{} @ {}".format(self.subject_accs, self.subject_spec)
+
+    @property
+    def domains(self):
+        return self._decode_domains(self._domains)
+
+    @property
+    def aligned_domains(self):
+        return self._decode_domains(self._aligned_domains)
+
+    @property
+    def non_gapped(self):
+        values = self._non_gapped
+        return list(zip(values[0::2], values[1::2]))
+
+    def _decode_domains(self, values):
+        """
+        Convierte un array de dominios en una lista de tuplas
+        (accession, start, end).
+        """
+        accessions = Protein.accessions
+        return [(accessions[values[i]], values[i+1], values[i+2])
+                for i in range(0, len(values), 3)]
 
     def add_domain(self, accession, start, end):
         """
         Añade un dominio conservado detectado.
         """
-        self.domains.append((accession, start, end))
+        self._domains.extend((Protein.accessions.add(accession), start, end))
 
     def add_alignment(self, aligned_seq):
         """
         Añade a la instancia la secuencia correspondiente a esa proteína dentro
         del alineamiento múltiple (con gaps) para después graficarlo.
         """
-        self.aligned_seq = aligned_seq
+        self.aligned_id = Protein.sequences.add(alignment_bytes(aligned_seq))
+
+    def reset_alignment(self):
+        """
+        Elimina el alineamiento y todo lo calculado sobre él, para volver a
+        alinear la proteína.
+        """
+        self.aligned_id = -1
+        self.representative = None
+        self._aligned_domains = array('i')
+        self._non_gapped = array('i')
 
     def add_aligned_domain(self, accession, start, end):
         """
@@ -102,74 +437,282 @@ class Protein:
         dentro de la secuencia alineada (con gaps), en lugar de en la secuencia
         original, para después graficar.
         """
-        self.aligned_domains.append((accession, start, end))
+        self._aligned_domains.extend((Protein.accessions.add(accession), start, end))
+
+    def ilustrate_alignment(self, runs):
+        """
+        Guarda las regiones de la secuenia alineada que se corresponden con
+        aminoácidos y no con gaps (guiones), para después graficar. 'runs' es
+        un array (n, 2) con su inicio y su final (ver
+        'alignment.non_gapped_runs').
+        """
+        self._non_gapped = array('i', runs.astype(np.intc).tobytes())
 
-    def ilustrate_alignment(self, start, end):
+    def copy_for_member(self, idx, subject_id):
         """
-        Añade regiones de la secuenia alineada que se corresponden con
-        aminoácidos y no con gaps (guiones), para después graficar.
+        Devuelve una copia de la instancia para otra proteína con la misma
+        secuencia ('subject_id'), con todo lo obtenido para el representante
+        (alineamiento, dominios...).
         """
-        self.non_gapped.append((start,end))
+        member = Protein.__new__(Protein)
+        for attribute in Protein.__slots__:
+            setattr(member, attribute, getattr(self, attribute))
+        member.index = int(idx)
+        member.subject_id = subject_id
+        member._domains = array('i', self._domains)
+        member._aligned_domains = array('i', self._aligned_domains)
+        member._non_gapped = array('i', self._non_gapped)
+        return(member)
+
+    def __setstate__(self, state):
+        """
+        Recupera una instancia de un fichero *.bapj. Los proyectos guardados
+        antes de usar '__slots__' guardan los atributos en un diccionario,
+        con las secuencias y los dominios en la propia instancia: se
+        incorporan a las tablas compartidas (ver 'Protein.sequences' y
+        'Protein.accessions').
+        """
+        if isinstance(state, tuple):
+            # Estado de una instancia con '__slots__': (None, atributos).
+            for attribute, value in state[1].items():
+                setattr(self, attribute, value)
+            return
+
+        for attribute in ("index", "query_id", "subject_id", "evalue",
+                          "query_cov", "ident", "range"):
+            setattr(self, attribute, state[attribute])
+        self.seq_id = Protein.sequences.add(str(state["subject_seq"]))
+        self.aligned_id = -1
+        if state.get("aligned_seq") is not None:
+            self.aligned_id = Protein.sequences.add(alignment_bytes(state["aligned_seq"]))
+        self.representative = None
+
+        self._domains = array('i')
+        self._aligned_domains = array('i')
+        self._non_gapped = array('i')
+        for accession, start, end in state.get("domains", ()):
+            self.add_domain(accession, start, end)
+        for accession, start, end in state.get("aligned_domains", ()):
+            self.add_aligned_domain(accession, start, end)
+        for start, end in state.get("non_gapped", ()):
+            self._non_gapped.extend((start, end))
 
     def import_queries_list(queries_list):
         """
         Permite recuperar la lista de queries al abrir el fichero *.bapj.
         """
-        Protein.queries = queries_list
+        Protein.queries = list(queries_list)
+        Protein._queries_set = set(queries_list)
+
+    def import_accessions_list(accessions_list):
+        """
+        Permite recuperar la tabla de accessions al abrir el fichero *.bapj.
+        """
+        Protein.accessions = InternTable(accessions_list)
+
+    def import_sequences_list(sequences_list):
+        """
+        Permite recuperar la tabla de secuencias al abrir el fichero *.bapj.
+        """
+        Protein.sequences = InternTable(sequences_list)
+
+    def compact_sequences(proteins):
+        """
+        Deja en la tabla de secuencias sólo las de las instancias de
+        'proteins' (las que ya no usa ninguna, p. ej. los alineamientos
+        sustituidos al volver a filtrar, se eliminan), y actualiza sus
+        posiciones en las instancias.
+        """
+        proteins = list(dict.fromkeys(proteins))
+        table = InternTable()
+        new_ids = {}
+        for protein in proteins:
+            for old_id in (protein.seq_id, protein.aligned_id):
+                if old_id >= 0 and old_id not in new_ids:
+                    new_ids[old_id] = table.add(Protein.sequences[old_id])
 
+        for protein in proteins:
+            protein.seq_id = new_ids[protein.seq_id]
+            if protein.aligned_id >= 0:
+                protein.aligned_id = new_ids[protein.aligned_id]
+        Protein.sequences = table
 
-def parse_blast_results(estruct_dir, Protein_class):
+
+def parse_blast_results(estruct_dir, Protein_class, seq_store, lines,
+                        evalue, coverage, ident, members=None, hits=None):
     """
-    Parsea el fichero tsv con los resultados del BLAST, y crea una instancia de
-    la clase 'Protein' para cada match, incluyendo en los atributos de
-    dicha instancia la información relevante del match.
+    Procesa la salida de blastp ('lines', ver 'blast_it') a medida que se
+    produce, y crea una instancia de la clase 'Protein' para cada match que
+    supere los umbrales, incluyendo en los atributos de dicha instancia la
+    información relevante del match.
+
+    Los resultados se guardan en la carpeta de resultados, sin filtrar
+    ('blast_results.tsv') y filtrados ('filtered_blast_results.tsv', ver
+    'filter_blast_lines'). Si se indica 'hits', se guardan en él todos los
+    resultados.
+
+    La secuencia original de cada match se recupera de 'seq_store' (el índice
+    construido por 'parse_input.make_genomes_multifasta').
     """
     proteins = [] # Genera una lista que contendrá todas las instancias.
 
-    with open (estruct_dir.file_in_results_dir("filtered_blast_results.tsv"), 'r') as results:
-        for idx, line in enumerate(results, start=1): # Recorre líneas del tsv
-            campos = line.split("\t")
+    matches = filter_blast_lines(lines, evalue, coverage, ident,
+                                 estruct_dir.file_in_results_dir("blast_results.tsv"),
+                                 estruct_dir.file_in_results_dir("filtered_blast_results.tsv"),
+                                 members, hits)
 
-            qseqid = campos[1]
+    for idx, campos in enumerate(matches, start=1):
+        qseqid = campos[1]
 
-            # Recupera la secuencia original del match, no la secuencia
-            # recortada que aparece en los resultados del BLAST.
-            with open(estruct_dir.file_in_data_dir("genomes_multifasta.fa")) as filehandle:
-                for record in SeqIO.parse(filehandle, "fasta"):
-                    if qseqid == record.id:
-                        original_sequence = str(record.seq)
+        # Recupera la secuencia original del match, no la secuencia
+        # recortada que aparece en los resultados del BLAST.
+        original_sequence = seq_store.get(qseqid)
 
-            proteins.append(Protein_class(idx, campos[0],
-                                          campos[1], original_sequence,
-                                          campos[3], campos[4],
-                                          campos[5], campos[6],
-                                          campos[7])) # Instancia la clase 'Protein'.
+        proteins.append(Protein_class(idx, campos[0],
+                                      campos[1], original_sequence,
+                                      campos[3], campos[4],
+                                      campos[5], campos[6],
+                                      campos[7])) # Instancia la clase 'Protein'.
 
     return(proteins)
 
 
-def build_multifasta_for_muscle(estruct_dir, proteins, Protein_class):
+def refilter_results(estruct_dir, hits, proteins, Protein_class, seq_store,
+                     evalue, coverage, ident, members=None):
+    """
+    Vuelve a filtrar los resultados del BLAST guardados en 'hits' (ver
+    'HitTable') con otros umbrales. Reescribe 'filtered_blast_results.tsv'.
+
+    Los resultados que ya estaban en 'proteins' (sin los miembros añadidos
+    por 'expand_members') se reutilizan con todo lo obtenido para ellos; para
+    el resto se crean instancias nuevas. Devuelve una tupla (resultados,
+    nuevos, queries con resultados nuevos, queries con resultados
+    eliminados).
     """
-    Genera un archivo multifasta para cada query que contiene:
+    previous = {(protein.query_id, protein.subject_id, protein.range): protein
+                for protein in proteins}
+
+    refiltered = []
+    added = []
+    with open(estruct_dir.file_in_results_dir("filtered_blast_results.tsv"), 'w') as filtered:
+        for idx, row in enumerate(hits.select(evalue, coverage, ident), start=1):
+            write_hit_line(filtered, hits.lines[row], members)
+            campos = hits.campos(row)
+            protein = previous.pop((campos[0], campos[1], (campos[6], campos[7])), None)
+            if protein is None:
+                protein = Protein_class(idx, campos[0],
+                                        campos[1], seq_store.get(campos[1]),
+                                        campos[3], campos[4],
+                                        campos[5], campos[6],
+                                        campos[7])
+                added.append(protein)
+            protein.index = idx
+            refiltered.append(protein)
+
+    # Los queries sin resultados dejan de aparecer en 'Protein.queries'.
+    order = {query: i for i, query in enumerate(Protein_class.queries)}
+    Protein_class.import_queries_list(sorted({protein.query_id for protein in refiltered},
+                                             key=lambda query: order[query]))
+
+    added_queries = {protein.query_id for protein in added}
+    removed_queries = {protein.query_id for protein in previous.values()} - added_queries
+
+    return(refiltered, added, added_queries, removed_queries)
+
+
+def expand_members(proteins, members):
+    """
+    Devuelve la lista de resultados incluyendo, a continuación de cada
+    representante, una copia (ver 'Protein.copy_for_member') para cada
+    miembro de su grupo de secuencias idénticas. Los índices se renumeran
+    para seguir el orden de la nueva lista.
+    """
+    expanded = []
+    for protein in proteins:
+        protein.index = len(expanded) + 1
+        expanded.append(protein)
+        for member in members.get(protein.subject_id, ()):
+            expanded.append(protein.copy_for_member(len(expanded) + 1, member))
+
+    return(expanded)
+
+
+def build_multifasta_for_muscle(estruct_dir, proteins, Protein_class, query_store, max_aligned=None,
+                                selection=None, export=False):
+    """
+    Genera un multifasta para cada query que contiene:
      - Los matches del BLAST
-     - La seucencia query
+     - La seucencia query (recuperada de 'query_store')
+
+    Devuelve un diccionario query -> multifasta (texto), que se envía
+    directamente a MUSCLE (ver 'muscle.multi_align'). Con 'export', cada
+    multifasta se guarda además en 'unaligned_matches/<query>_matches.fa'.
+
+    Si se indica 'max_aligned' y un query tiene más resultados, éstos se
+    agrupan por similitud (ver 'cluster.select_representatives') y sólo se
+    incluye en el multifasta un representante de cada grupo. El
+    representante de cada resultado se guarda en su atributo
+    'representative', y en el fichero 'representatives/<query>.tsv'.
+
+    Si se indica 'selection', sólo se generan los de esos queries.
     """
     # Crea el directorio donde se van a almacenar los multifasta.
-    os.mkdir(estruct_dir.file_in_results_dir("unaligned_matches"))
+    if export:
+        os.makedirs(estruct_dir.file_in_results_dir("unaligned_matches"), exist_ok=True)
+    if max_aligned:
+        os.makedirs(estruct_dir.file_in_results_dir("representatives"), exist_ok=True)
+
+    # Agrupa las instancias por query, conservando su orden.
+    by_query = {}
+    for protein in proteins:
+        by_query.setdefault(protein.query_id, []).append(protein)
+
+    fastas = {}
 
     # Recorre la lista de queries con las que se ha instanciado la clase Protein
     for query in Protein_class.queries:
-        # Abre el futuro fichero multifasta.
-        with open(estruct_dir.file_in_results_dir("unaligned_matches/{}_matches.fa".format(query)), 'w') as out:
-            for protein in proteins:
-                # Identifica las instancias correspondientes a ese query.
-                if protein.query_id == query:
-                    out.write(">{}\n{}\n\n".format(protein.subject_id, protein.subject_seq))
-
-            # Visita el fichero de queries para recuperar la secuencia query.
-            with open(estruct_dir.file_in_data_dir("queries.fa"), 'r') as input_handle:
-                for record in SeqIO.parse(input_handle, "fasta"):
-                    if record.id == query:
-                        sequence = str(record.seq)
-                        header = record.id
-                        out.write(">{}\n{}\n\n".format(header, sequence))
+        if selection is not None and query not in selection:
+            continue
+
+        # Identifica las instancias correspondientes a ese query.
+        matches = by_query.get(query, [])
+
+        if max_aligned and len(matches) > max_aligned:
+            nearest = cluster.select_representatives(
+                    [protein.subject_seq for protein in matches], max_aligned)
+            for protein, representative in zip(matches, nearest):
+                protein.representative = matches[representative].subject_id
+            write_representatives(estruct_dir, query, matches)
+            matches = [protein for protein in matches
+                       if protein.representative == protein.subject_id]
+        else:
+            # Agrupación de una ejecución anterior (ver 'refilter_results').
+            old_representatives = estruct_dir.file_in_results_dir("representatives/{}.tsv".format(query))
+            if os.path.exists(old_representatives):
+                os.remove(old_representatives)
+
+        records = [">{}\n{}\n\n".format(protein.subject_id, protein.subject_seq)
+                   for protein in matches]
+        records.append(">{}\n{}\n\n".format(query, query_store.get(query)))
+        fastas[query] = "".join(records)
+
+        if export:
+            with open(estruct_dir.file_in_results_dir("unaligned_matches/{}_matches.fa".format(query)), 'w') as out:
+                out.write(fastas[query])
+
+    return(fastas)
+
+
+def write_representatives(estruct_dir, query, proteins):
+    """
+    Guarda, para cada resultado del query, el subject id del representante
+    con el que se ha alineado (ver 'build_multifasta_for_muscle').
+    """
+    folder = estruct_dir.file_in_results_dir("representatives")
+    os.makedirs(folder, exist_ok=True)
+
+    with open("{}/{}.tsv".format(folder, query), 'w') as out:
+        out.write("Query\tProtein\tRepresentative\n")
+        for protein in proteins:
+            out.write("{}\t{}\t{}\n".format(query, protein.subject_id,
+                                              protein.representative))
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+#
+# BLAntarctic v0.1 - 'cache' module
+#
+# Gestión de la caché compartida entre proyectos (bases de datos, resultados
+# intermedios reutilizables, etc.).
+#
+
+import os
+import shutil
+import hashlib
+
+
+# La caché se crea, como el resto de carpetas de salida, fuera de la carpeta
+# del paquete. Se puede usar otra con la variable de entorno
+# BLANTARCTIC_CACHE (ver 'check_pipeline.py').
+CACHE_ROOT = os.environ.get("BLANTARCTIC_CACHE", "../BLAntarctic_cache")
+
+# Tamaño máximo de la caché por defecto (en bytes). Ver 'evict'.
+DEFAULT_BUDGET = 20 * (1 << 30)
+
+
+def cache_dir(*subdirs):
+    """
+    Devuelve el path de un subdirectorio de la caché, creándolo si no existe.
+    """
+    path = "/".join((CACHE_ROOT,) + subdirs)
+    os.makedirs(path, exist_ok=True)
+    return(path)
+
+
+def hash_file(path):
+    """
+    Calcula el hash SHA-256 del contenido de un fichero.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as handle:
+        for block in iter(lambda: handle.read(1 << 20), b''):
+            digest.update(block)
+    return(digest.hexdigest())
+
+
+def hash_files(paths):
+    """
+    Calcula un hash conjunto del contenido de varios ficheros. No depende del
+    orden ni del nombre de los ficheros, sólo de su contenido.
+    """
+    digest = hashlib.sha256()
+    for file_hash in sorted(hash_file(path) for path in paths):
+        digest.update(file_hash.encode())
+    return(digest.hexdigest())
+
+
+def list_files(folder_path):
+    """
+    Devuelve los paths de los ficheros (no directorios) de una carpeta.
+    """
+    paths = []
+    for filename in sorted(os.listdir(folder_path)):
+        path = "{}/{}".format(folder_path, filename)
+        if os.path.isfile(path):
+            paths.append(path)
+    return(paths)
+
+
+def touch(path):
+    """
+    Marca una entrada de la caché como usada en este momento (es lo que se
+    tiene en cuenta al eliminar entradas, ver 'evict').
+    """
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
+
+
+def link_or_copy(source, destination):
+    """
+    Crea un enlace duro a un fichero o, si no es posible (p. ej. si están en
+    sistemas de ficheros distintos), lo copia.
+    """
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+    return(destination)
+
+
+def copy_artifact(source, destination, link=False):
+    """
+    Copia un fichero o directorio. Con 'link=True', los ficheros se enlazan
+    (ver 'link_or_copy') en lugar de copiarse: sólo debe usarse con ficheros
+    que nunca se modifican, porque el original y el enlace son el mismo
+    fichero.
+    """
+    copy_function = link_or_copy if link else shutil.copy2
+    parent = os.path.dirname(destination)
+    if parent:
+        os.makedirs(parent, exist_ok=True)
+    if os.path.isdir(source):
+        shutil.copytree(source, destination, copy_function=copy_function)
+    else:
+        copy_function(source, destination)
+
+
+def remove_artifact(path):
+    """
+    Elimina un fichero o directorio, si existe.
+    """
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+def stage_entry(stage, key):
+    return "/".join((CACHE_ROOT, "stages", stage, key))
+
+
+def store_stage(stage, key, artifacts):
+    """
+    Guarda en la caché los ficheros de salida de una etapa del análisis, bajo
+    su clave (ver 'manifest.StageManifest'). 'artifacts' es una lista de
+    tuplas (path, nombre en la caché, enlazar): con 'enlazar', se usan
+    enlaces duros en lugar de copias (ver 'copy_artifact').
+    """
+    entry = stage_entry(stage, key)
+    if os.path.isdir(entry):
+        touch(entry)
+        return(entry)
+
+    # Se guarda en un directorio temporal y se renombra al final, para que
+    # otro proceso nunca encuentre una entrada a medio guardar.
+    temp = "{}.{}.tmp".format(entry, os.getpid())
+    remove_artifact(temp)
+    os.makedirs(temp)
+    for path, name, link in artifacts:
+        copy_artifact(path, "{}/{}".format(temp, name), link)
+
+    try:
+        os.rename(temp, entry)
+    except OSError:
+        # Otro proceso ha guardado la misma entrada.
+        shutil.rmtree(temp, ignore_errors=True)
+
+    return(entry)
+
+
+def restore_stage(stage, key, artifacts):
+    """
+    Recupera de la caché los ficheros de salida de una etapa (ver
+    'store_stage'), reemplazando los que haya en el proyecto. Devuelve
+    'False' si la etapa no está en la caché.
+    """
+    entry = stage_entry(stage, key)
+    if not all(os.path.exists("{}/{}".format(entry, name)) for path, name, link in artifacts):
+        return(False)
+
+    for path, name, link in artifacts:
+        remove_artifact(path)
+        copy_artifact("{}/{}".format(entry, name), path, link)
+
+    touch(entry)
+    return(True)
+
+
+def tree_size(path):
+    """
+    Tamaño en bytes de un fichero, o de todos los ficheros de un directorio.
+    """
+    if not os.path.isdir(path):
+        return(os.path.getsize(path))
+    size = 0
+    for folder, subfolders, filenames in os.walk(path):
+        for filename in filenames:
+            size += os.path.getsize(os.path.join(folder, filename))
+    return(size)
+
+
+def cache_entries():
+    """
+    Devuelve una lista de tuplas (último uso, tamaño, paths) con las entradas
+    de la caché: cada proteoma (sus ficheros '.fa' e '.idx'), cada base de
+    datos de BLAST y los resultados guardados de cada etapa.
+    """
+    entries = []
+
+    proteomes = "{}/proteomes".format(CACHE_ROOT)
+    if os.path.isdir(proteomes):
+        groups = {}
+        for filename in os.listdir(proteomes):
+            if not filename.endswith(".tmp"):
+                groups.setdefault(filename.rsplit(".", 1)[0], []).append(
+                        "{}/{}".format(proteomes, filename))
+        for paths in groups.values():
+            entries.append((max(os.path.getmtime(path) for path in paths),
+                            sum(os.path.getsize(path) for path in paths), paths))
+
+    folders = []
+    if os.path.isdir("{}/blastdb".format(CACHE_ROOT)):
+        folders.append("{}/blastdb".format(CACHE_ROOT))
+    if os.path.isdir("{}/stages".format(CACHE_ROOT)):
+        folders += ["{}/stages/{}".format(CACHE_ROOT, stage)
+                    for stage in os.listdir("{}/stages".format(CACHE_ROOT))]
+    for folder in folders:
+        for name in os.listdir(folder):
+            path = "{}/{}".format(folder, name)
+            if not name.endswith(".tmp"):
+                entries.append((os.path.getmtime(path), tree_size(path), [path]))
+
+    return(entries)
+
+
+def evict(budget=DEFAULT_BUDGET):
+    """
+    Elimina las entradas de la caché usadas hace más tiempo (LRU) hasta que
+    su tamaño total no supere 'budget' bytes. Devuelve el número de bytes
+    liberados.
+
+    Los proyectos no dependen de la caché: los ficheros que se recuperan de
+    ella se copian o enlazan en sus carpetas, así que eliminar una entrada
+    nunca rompe un proyecto existente.
+    """
+    entries = sorted(cache_entries(), key=lambda entry: entry[0])
+    total = sum(size for used, size, paths in entries)
+
+    freed = 0
+    for used, size, paths in entries:
+        if total <= budget:
+            break
+        for path in paths:
+            remove_artifact(path)
+        total -= size
+        freed += size
+
+    return(freed)
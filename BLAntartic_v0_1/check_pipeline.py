@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+#
+# BLAntarctic v0.1 - comprobación de '--pipeline'
+#
+# Analiza los mismos genomas y queries dos veces, por etapas y con
+# '--pipeline', y comprueba que los ficheros de resultados coinciden (salvo
+# los plots, el fichero del proyecto y 'manifest.json', que incluyen fechas
+# o no son deterministas).
+#
+# USO:
+#     python check_pipeline.py carpeta_GBs queries.fa [--real] [opciones]
+#
+# Por defecto se usan los sustitutos de blastp, makeblastdb y muscle de la
+# carpeta 'stubs' (deterministas y sin dependencias), con una caché propia
+# para no mezclar sus bases de datos con las reales. Con '--real' se usan
+# los programas instalados. El resto de opciones (p. ej. '--ident 10' o
+# '--max-aligned 3') se pasan a las dos ejecuciones. Debe ejecutarse desde
+# la carpeta del paquete (junto a 'prosite.dat').
+#
+
+import filecmp
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import dirs
+
+
+# Ficheros que no se comparan.
+IGNORED_NAMES = ("project.bapj", "manifest.json")
+IGNORED_EXTENSIONS = (".png", ".pdf")
+
+
+def results_dir(project_name):
+    """
+    Devuelve el path de la carpeta de resultados que creará el programa para
+    un proyecto nuevo (ver 'dirs.crea_directorios').
+    """
+    index = dirs.calcula_indice(project_name)
+    if index == 0:
+        return("../{}_results".format(project_name))
+    return("../{}_results_{}".format(project_name, index))
+
+
+def run(project_name, arguments, env):
+    """
+    Ejecuta el programa y devuelve la carpeta de resultados.
+    """
+    path = results_dir(project_name)
+    command = [sys.executable, "BLAntractic.py", "-n", project_name] + arguments
+    completed = subprocess.run(command, env=env, stdout=subprocess.DEVNULL)
+    if completed.returncode != 0:
+        print("ERROR: '{}' ha terminado con código {}.".format(
+                " ".join(command), completed.returncode))
+        sys.exit(1)
+    return(path)
+
+
+def compared_files(path):
+    """
+    Devuelve los paths (relativos a 'path') de los ficheros que se comparan.
+    """
+    files = set()
+    for folder, subfolders, filenames in os.walk(path):
+        for filename in filenames:
+            if filename in IGNORED_NAMES or filename.endswith(IGNORED_EXTENSIONS):
+                continue
+            files.add(os.path.relpath(os.path.join(folder, filename), path))
+    return(files)
+
+
+def compare(expected_path, obtained_path):
+    """
+    Devuelve una lista con las diferencias entre dos carpetas de resultados
+    (vacía si coinciden).
+    """
+    expected = compared_files(expected_path)
+    obtained = compared_files(obtained_path)
+
+    differences = ["Sólo por etapas: " + name for name in sorted(expected - obtained)]
+    differences += ["Sólo con --pipeline: " + name for name in sorted(obtained - expected)]
+    for name in sorted(expected & obtained):
+        if not filecmp.cmp(os.path.join(expected_path, name),
+                           os.path.join(obtained_path, name), shallow=False):
+            differences.append("Distinto: " + name)
+    return(differences)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print("USO: python check_pipeline.py carpeta_GBs queries.fa [--real] [opciones]")
+        sys.exit(2)
+
+    genomes, queries = sys.argv[1], sys.argv[2]
+    options = [option for option in sys.argv[3:] if option != "--real"]
+    arguments = ["-s", genomes, "-q", queries, "--cache-budget", "0"] + options
+
+    # Sin ventanas: el menú interactivo final no se abre.
+    env = dict(os.environ, MPLBACKEND="Agg")
+    cache_root = None
+    if "--real" not in sys.argv:
+        stubs = os.path.abspath("stubs")
+        env["PATH"] = stubs + os.pathsep + env.get("PATH", "")
+        cache_root = tempfile.mkdtemp(prefix="BLAntarctic_check_cache_")
+        env["BLANTARCTIC_CACHE"] = cache_root
+
+    print("Ejecutando por etapas...")
+    expected_path = run("pipelinecheck_stages", arguments, env)
+    print("Ejecutando con --pipeline...")
+    obtained_path = run("pipelinecheck_pipeline", arguments + ["--pipeline"], env)
+
+    differences = compare(expected_path, obtained_path)
+    compared = len(compared_files(expected_path))
+
+    if cache_root is not None:
+        shutil.rmtree(cache_root)
+    for path in (expected_path, obtained_path):
+        shutil.rmtree(path)
+        shutil.rmtree(path.replace("_results", "_data", 1))
+
+    if differences:
+        print("ERROR: los resultados no coinciden ({} diferencias).".format(len(differences)))
+        for difference in differences[:20]:
+            print("    " + difference)
+        sys.exit(1)
+
+    print("Los resultados coinciden ({} ficheros).".format(compared))
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+#
+# BLAntarctic v0.1 - 'cluster' module
+#
+# Agrupa secuencias parecidas (mediante sketches MinHash de sus k-meros) y
+# elige un representante de cada grupo, para no tener que alinear todos los
+# resultados del BLAST de un query.
+#
+
+import numpy as np
+
+
+# Longitud de los k-meros y número de funciones hash de cada sketch.
+KMER_SIZE = 4
+SKETCH_SIZE = 64
+
+# Funciones hash (a*x + b) mod p, iguales en todas las ejecuciones.
+_PRIME = (1 << 31) - 1
+_random = np.random.RandomState(2020)
+_HASH_A = _random.randint(1, _PRIME, size=(SKETCH_SIZE, 1)).astype(np.int64)
+_HASH_B = _random.randint(0, _PRIME, size=(SKETCH_SIZE, 1)).astype(np.int64)
+
+
+def kmer_codes(sequence, k=KMER_SIZE):
+    """
+    Devuelve un array con un entero para cada k-mero (distinto) de la
+    secuencia. Cada residuo ocupa 5 bits del entero.
+    """
+    residues = np.frombuffer(sequence.upper().encode(), dtype=np.uint8) & 31
+    n = len(residues) - k + 1
+    if n <= 0:
+        return(np.zeros(0, dtype=np.int64))
+
+    codes = np.zeros(n, dtype=np.int64)
+    for i in range(k):
+        codes = (codes << 5) | residues[i:i+n]
+    return(np.unique(codes))
+
+
+def sketch(sequence):
+    """
+    Calcula el sketch MinHash de una secuencia: el mínimo de cada función
+    hash sobre sus k-meros. La proporción de posiciones en las que coinciden
+    los sketches de dos secuencias estima la similitud (Jaccard) de sus
+    conjuntos de k-meros.
+    """
+    codes = kmer_codes(sequence)
+    if len(codes) == 0:
+        return(np.full(SKETCH_SIZE, _PRIME, dtype=np.int64))
+    return(((_HASH_A * codes + _HASH_B) % _PRIME).min(axis=1))
+
+
+def select_representatives(sequences, max_representatives):
+    """
+    Agrupa las secuencias en, como mucho, 'max_representatives' grupos y
+    devuelve una lista con la posición del representante de cada secuencia
+    (los representantes son su propio representante).
+
+    Los representantes se eligen de forma voraz: el primero es la primera
+    secuencia (el mejor resultado del BLAST), y cada uno de los siguientes es
+    la secuencia menos parecida a los ya elegidos. Al final, cada secuencia
+    queda asignada al representante más parecido. Si todas las secuencias
+    restantes son idénticas (según el sketch) a algún representante, no se
+    eligen más.
+    """
+    n = len(sequences)
+    if n == 0:
+        return([])
+
+    sketches = np.array([sketch(str(sequence)) for sequence in sequences])
+
+    nearest = np.zeros(n, dtype=np.int64)
+    similarity = (sketches == sketches[0]).mean(axis=1)
+    similarity[0] = 2.0 # Los representantes no se vuelven a elegir.
+
+    for _ in range(1, min(max_representatives, n)):
+        candidate = int(similarity.argmin())
+        if similarity[candidate] >= 1.0:
+            break
+        candidate_similarity = (sketches == sketches[candidate]).mean(axis=1)
+        closer = candidate_similarity > similarity
+        nearest[closer] = candidate
+        similarity[closer] = candidate_similarity[closer]
+        similarity[candidate] = 2.0
+        nearest[candidate] = candidate
+
+    return(nearest.tolist())
@@ -45,6 +45,14 @@ class EstructuraDirectorios:
         """
         return "{}/{}".format(self.rel_data_path, filename)
 
+    def artifact_path(self, kind, filename):
+        """
+        Devuelve el path relativo de un fichero de nombre 'filename' en la
+        carpeta de resultados ('kind="results"') o de datos ('kind="data"').
+        """
+        if kind == "data":
+            return self.file_in_data_dir(filename)
+        return self.file_in_results_dir(filename)
 
 
 def calcula_indice(nombre_proyecto):
@@ -87,11 +95,23 @@ def calcula_indice(nombre_proyecto):
         return(maximo+1)
 
 
+def ultimo_indice(nombre_proyecto):
+    """
+    Devuelve el índice de los últimos directorios creados con el nombre de
+    proyecto (ver 'calcula_indice'), o 'None' si no hay ninguno.
+    """
+    indice = calcula_indice(nombre_proyecto)
+    if indice == 0:
+        return(None)
+    return(indice - 1)
+
+
 def crea_directorios(index, nombre_proyecto, *argv):
     """
     Crea los directorios con nombre basado en los 'argv*', con el índice numérico que se indique y el nombre de proyecto. Según la estructura:
                          'NombreProyecto_argv_index'
     Devuelve, además, una tupla con los paths relativos de los directorios que ha creado.
+    Si los directorios ya existen (al reanudar una ejecución), se reutilizan.
     """
 
     lista = []
@@ -99,12 +119,32 @@ def crea_directorios(index, nombre_proyecto, *argv):
         # Si el índice es 0, no se añade al nombre.
         for arg in argv:
             directorio = "../{}_{}".format(nombre_proyecto, arg)
-            os.mkdir(directorio)
+            os.makedirs(directorio, exist_ok=True)
             lista.append(directorio)
     else:
         for arg in argv:
             directorio = "../{}_{}_{}".format(nombre_proyecto, arg, index)
-            os.mkdir(directorio)
+            os.makedirs(directorio, exist_ok=True)
             lista.append(directorio)
 
     return(tuple(lista))
+
+
+def elimina_resultados_query(estruct_dir, query):
+    """
+    Elimina los ficheros de resultados de un query (multifasta, alineamiento,
+    árbol, dominios y plot), cuando deja de tener resultados.
+    """
+    indice = query.split("_")[0]
+    ficheros = ["unaligned_matches/{}_matches.fa".format(query),
+                "aligned_matches/{}_aligned.fa".format(query),
+                "trees_nw/{}_tree.nw".format(indice),
+                "trees_plot/{}_tree_plot.pdf".format(indice),
+                "protein_domains/{}_domains.tsv".format(query),
+                "representatives/{}.tsv".format(query),
+                "plots/{}.png".format(query)]
+
+    for fichero in ficheros:
+        path = estruct_dir.file_in_results_dir(fichero)
+        if os.path.exists(path):
+            os.remove(path)
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+#
+# BLAntarctic v0.1 - 'gbscan' module
+#
+# Lector rápido de ficheros GeneBank, que sólo extrae la información de los
+# CDSs que necesita el programa (en lugar de construir 'SeqRecord' completos
+# con BioPython, incluyendo la secuencia de nucleótidos).
+#
+# Ejecutado como script, compara sus resultados con los de BioPython:
+#     python gbscan.py genoma1.gbff [genoma2.gbff ...]
+#
+
+import sys
+
+from Bio import SeqIO
+from Bio.SeqFeature import Location, LocationParserError
+
+
+# Calificadores de los CDSs que se extraen.
+QUALIFIERS = ("locus_tag", "translation", "product", "EC_number")
+
+# Columna en la que empiezan las localizaciones y calificadores de la tabla
+# de features.
+QUALIFIER_INDENT = 21
+
+
+def clean_value(key, value):
+    """
+    Limpia el valor de un calificador igual que BioPython: quita las comillas,
+    deshace el escapado de comillas dobles y, en las traducciones, elimina
+    los espacios.
+    """
+    if len(value) > 1 and value[0] == '"' and value[-1] == '"':
+        value = value[1:-1]
+    value = value.replace('""', '"')
+    if key == "translation":
+        value = value.replace(" ", "")
+    return(value)
+
+
+def format_location(location, length=None, circular=False, stranded=True):
+    """
+    Convierte una localización tal como aparece en el fichero ('87..1109') al
+    formato en que la muestra BioPython ('[86:1109](+)', es decir,
+    'str(feature.location)'), interpretándola igual que su parser de
+    GeneBank. 'length', 'circular' y 'stranded' son los del record (ver
+    'parse_locus'): los dos primeros sólo afectan a las localizaciones que
+    cruzan el origen, y en los records de proteínas no hay hebra.
+    """
+    if "replace" in location:
+        # Localizaciones antiguas como replace(266,"c"): sólo la posición.
+        location = location[8:location.find(",")]
+    try:
+        return(str(Location.fromstring(location, length, circular, stranded)))
+    except LocationParserError:
+        # BioPython deja el feature sin localización.
+        return(str(None))
+
+
+def parse_locus(line):
+    """
+    Devuelve una tupla (longitud, circular, stranded) con la longitud de la
+    secuencia (o 'None'), si es circular y si es de nucleótidos (y por tanto
+    sus features tienen hebra), a partir de la línea LOCUS de un record.
+    """
+    fields = line.split()
+    length = None
+    stranded = True
+    for position, field in enumerate(fields[1:], 1):
+        if field in ("bp", "aa") and fields[position-1].isdigit():
+            length = int(fields[position-1])
+            stranded = field == "bp"
+    return(length, "circular" in (field.lower() for field in fields), stranded)
+
+
+def parse_cds(lines):
+    """
+    Procesa las líneas de un CDS (sin la indentación, la primera es la
+    localización) y devuelve un diccionario con su localización ('location')
+    y el primer valor de cada calificador de QUALIFIERS que contenga.
+    """
+    # La localización puede ocupar varias líneas, hasta el primer calificador.
+    end = 1
+    while end < len(lines) and not lines[end].startswith("/"):
+        end += 1
+    location = "".join(lines[:end])
+    iterator = iter(lines[end:])
+
+    cds = {"location": location}
+    key = None
+    value_lines = []
+
+    def store():
+        if key in QUALIFIERS and key not in cds:
+            cds[key] = clean_value(key, " ".join(value_lines))
+
+    open_quote = False
+    for line in iterator:
+        if not open_quote and line.startswith("/"):
+            # Nuevo calificador.
+            store()
+            key, sep, value = line[1:].partition("=")
+            value_lines = [value]
+            open_quote = (len(value) > 1 and value.startswith('"')
+                          and not value.endswith('"'))
+        else:
+            # Continuación del calificador anterior.
+            value_lines.append(line)
+            if open_quote and line.endswith('"'):
+                open_quote = False
+    store()
+
+    return(cds)
+
+
+def scan_records(handle):
+    """
+    Recorre un fichero GeneBank abierto en 'handle' y genera, para cada
+    record, una tupla (description, cds_list): la definición del record (como
+    'SeqRecord.description') y una lista con los CDSs (ver 'parse_cds').
+
+    Sólo se procesan la cabecera y la tabla de features: a partir de ORIGIN
+    las líneas se saltan sin procesar hasta el final del record. Las
+    localizaciones se devuelven en el formato de BioPython (ver
+    'format_location').
+    """
+    description = ""
+    length, circular, stranded = None, False, True
+    cds_list = []
+    feature_lines = None
+    in_definition = False
+    in_features = False
+
+    for line in handle:
+        if in_features:
+            if line[:1] == " ":
+                line = line.rstrip("\r\n")
+                if line[5:6] != " ":
+                    # Nuevo feature.
+                    if feature_lines is not None:
+                        cds_list.append(parse_cds(feature_lines))
+                    if line[5:QUALIFIER_INDENT].strip() == "CDS":
+                        feature_lines = [line[QUALIFIER_INDENT:].strip()]
+                    else:
+                        feature_lines = None
+                elif feature_lines is not None:
+                    feature_lines.append(line[QUALIFIER_INDENT:].strip())
+                continue
+
+            # Fin de la tabla de features (ORIGIN, CONTIG, '//'...).
+            if feature_lines is not None:
+                cds_list.append(parse_cds(feature_lines))
+                feature_lines = None
+            in_features = False
+            if not line.startswith("//"):
+                # Salta la secuencia sin procesarla.
+                for line in handle:
+                    if line.startswith("//"):
+                        break
+
+            if description.endswith("."):
+                description = description[:-1]
+            for cds in cds_list:
+                cds["location"] = format_location(cds["location"], length, circular, stranded)
+            yield(description, cds_list)
+
+            description = ""
+            cds_list = []
+            length, circular, stranded = None, False, True
+
+        elif line.startswith("LOCUS"):
+            length, circular, stranded = parse_locus(line)
+
+        elif line.startswith("DEFINITION"):
+            description = line[12:].strip()
+            in_definition = True
+
+        elif in_definition and line.startswith(" "):
+            description += " " + line.strip()
+
+        elif line.startswith("FEATURES"):
+            in_definition = False
+            in_features = True
+
+        else:
+            in_definition = False
+
+
+def compare_with_biopython(path):
+    """
+    Compara los CDSs extraídos por 'scan_records' con los que extrae
+    BioPython del mismo fichero (descripción, y localización, locus_tag,
+    traducción, producto y número EC de cada CDS). Devuelve una lista con
+    las diferencias encontradas (vacía si coinciden).
+    """
+    expected = []
+    try:
+        with open(path, "r") as input_handle:
+            for record in SeqIO.parse(input_handle, "genbank"):
+                for feature in record.features:
+                    if feature.type == 'CDS':
+                        expected.append((record.description, str(feature.location)) + tuple(
+                                feature.qualifiers.get(key, [None])[0]
+                                for key in QUALIFIERS))
+    except Exception as error:
+        return(["BioPython no puede leer el fichero: {}".format(error)])
+
+    obtained = []
+    with open(path, "r") as input_handle:
+        for description, cds_list in scan_records(input_handle):
+            for cds in cds_list:
+                obtained.append((description, cds["location"]) + tuple(
+                        cds.get(key) for key in QUALIFIERS))
+
+    differences = []
+    if len(expected) != len(obtained):
+        differences.append("Número de CDSs: {} (BioPython) / {} (gbscan)".format(
+                len(expected), len(obtained)))
+    for bio, fast in zip(expected, obtained):
+        if bio != fast:
+            differences.append("{} / {}".format(bio, fast))
+
+    return(differences)
+
+
+if __name__ == "__main__":
+    errors = 0
+    for path in sys.argv[1:]:
+        differences = compare_with_biopython(path)
+        if differences:
+            errors += 1
+            print("{}: {} diferencias".format(path, len(differences)))
+            for difference in differences[:10]:
+                print("    " + difference)
+        else:
+            print("{}: OK".format(path))
+    sys.exit(1 if errors else 0)
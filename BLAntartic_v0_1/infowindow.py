@@ -10,68 +10,94 @@ from tkinter import ttk
 import os
 import textwrap
 
-from Bio.ExPASy import Prosite,Prodoc
-from Bio import Seq
-from Bio import SeqIO
+import gbscan
+import parse_input
+import prosite
 
 
 def retrieve_form_prosite(accession):
     """
     Recupera de prosite.dat y prosite.doc la información relativa al dominio
-    conservado que se va a mostrar en la ventana.
+    conservado que se va a mostrar en la ventana. Sólo se leen los dos records
+    necesarios (ver 'prosite.load_prosite_index').
     """
-    with open('./prosite.dat','r') as handle:
-        dat_records = Prosite.parse(handle)
-        for record in dat_records:
-            if record.accession == accession:
-                name = record.name
-                description = record.description
-                pattern = record.pattern
-                doc_accession = record.pdoc
-
-    with open('./prosite.doc','r',  encoding='latin1') as handle:
-        doc_records = Prodoc.parse(handle)
-        for record in doc_records:
-            if record.accession == doc_accession:
-                text = record.text
+    record = prosite.read_prosite_record(accession)
+    name = record.name
+    description = record.description
+    pattern = record.pattern
+    doc_accession = record.pdoc
+
+    text = prosite.read_prodoc_record(doc_accession).text
 
     return(name, description, pattern, text)
 
 
+# Índices del proyecto ya cargados, para que sólo el primer clic tenga que
+# leerlos de disco.
+_loaded_indexes = {}
+
+
+def project_indexes(estruct_dir):
+    """
+    Devuelve el índice de secuencias y el de anotaciones del proyecto
+    (ver 'parse_input.make_genomes_multifasta'), cargándolos sólo la primera
+    vez. Si el proyecto no los tiene (proyectos antiguos), devuelve 'None'
+    en su lugar.
+    """
+    key = estruct_dir.rel_data_path
+    if key not in _loaded_indexes:
+        try:
+            seq_store = parse_input.load_sequence_store(
+                    estruct_dir.file_in_data_dir("genomes_index.pkl"))
+        except:
+            seq_store = None
+        try:
+            annotations = parse_input.load_annotations(estruct_dir)
+        except:
+            annotations = None
+        _loaded_indexes[key] = (seq_store, annotations)
+
+    return(_loaded_indexes[key])
+
+
 def retrieve_from_GB(estruct_dir, protein):
     """
-    Recupera del fichero GeneBank correspondiente la información relativa a la
-    proteína donde se encuentra el dominio y el genoma del que procede, para mostrarlo en la ventana.
+    Recupera la información relativa a la proteína donde se encuentra el
+    dominio y el genoma del que procede, para mostrarlo en la ventana.
+
+    La traducción y la anotación del CDS se recuperan de los índices creados
+    al procesar los GeneBanks. Sólo en proyectos antiguos, que no los
+    tienen, se vuelve a leer el fichero GeneBank de la especie.
     """
 
     accession, species = protein.split("@")
 
+    seq_store, annotations = project_indexes(estruct_dir)
+
+    try:
+        raw_translation = seq_store.get(protein)
+        translation = textwrap.fill(raw_translation, 58, break_long_words=True)
+    except:
+        translation = "N/A"
+
+    location = EC_number = product = "N/A"
+
+    if annotations is not None:
+        if protein in annotations:
+            location, EC_number, product = annotations[protein]
+        return(species, accession, location, EC_number, product, translation)
+
     path = estruct_dir.file_in_data_dir("raw_GBs")
 
     for filename in os.listdir(path):
         if filename == species+".gbff":
             with open("{}/{}".format(path, filename), "r") as input_handle:
-                for record in SeqIO.parse(input_handle, "genbank"):
-                    for feature in record.features:
-                        if (feature.type == 'CDS'
-                            and feature.qualifiers['locus_tag'][0] == accession):
-                            location = feature.location
-
-                            try:
-                                EC_number = feature.qualifiers['EC_number'][0]
-                            except:
-                                EC_number = "N/A"
-
-                            try:
-                                product = feature.qualifiers['product'][0]
-                            except:
-                                product = "N/A"
-
-                            try:
-                                raw_translation = feature.qualifiers['translation'][0]
-                                translation = textwrap.fill(raw_translation, 58, break_long_words=True)
-                            except:
-                                translation = "N/A"
+                for description, cds_list in gbscan.scan_records(input_handle):
+                    for cds in cds_list:
+                        if cds.get('locus_tag') == accession:
+                            location = cds['location']
+                            EC_number = cds.get('EC_number', "N/A")
+                            product = cds.get('product', "N/A")
 
     return(species, accession, location, EC_number, product, translation)
 
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+#
+# BLAntarctic v0.1 - 'manifest' module
+#
+# Registro de las etapas del análisis que se han completado, para poder
+# reanudar una ejecución interrumpida ('--resume'), y caché de los resultados
+# de cada etapa compartida entre proyectos.
+#
+
+import json
+import hashlib
+import os
+import time
+
+import cache
+
+
+class StageManifest:
+    """
+    Registro de etapas completadas, guardado en 'manifest.json' en la
+    carpeta de resultados. De cada etapa se guarda una clave (hash de sus
+    parámetros y de la clave de la etapa anterior), los parámetros y sus
+    ficheros de salida.
+
+    Al reanudar, una etapa se salta si su clave coincide con la registrada
+    y sus ficheros de salida existen. A partir de la primera etapa que no
+    se puede saltar, se ejecutan todas las siguientes.
+
+    Además, los ficheros de salida de cada etapa completada se guardan en la
+    caché bajo su clave (ver 'cache.store_stage'). Como la clave depende de
+    los inputs y parámetros de todas las etapas anteriores, cualquier
+    proyecto que llegue a una etapa con la misma clave recupera sus
+    resultados en lugar de ejecutarla. Los ficheros de la carpeta de datos
+    se enlazan (nunca se modifican una vez escritos) y los de la de
+    resultados se copian ('--refilter' los reescribe).
+    """
+
+    def __init__(self, estruct_dir, resume=False, use_cache=True):
+        self.estruct_dir = estruct_dir
+        self.path = estruct_dir.file_in_results_dir("manifest.json")
+        self.stages = {}
+        if resume and os.path.exists(self.path):
+            with open(self.path, 'r') as input:
+                self.stages = json.load(input)
+        self.resuming = resume
+        self.use_cache = use_cache
+        self.previous_key = ""
+        self.current = None
+        self.pending = {}
+
+    def stage_key(self, params):
+        """
+        Devuelve la clave de una etapa con los parámetros 'params' (un
+        diccionario), encadenada con la de la etapa anterior.
+        """
+        content = json.dumps([self.previous_key, params], sort_keys=True, default=str)
+        return(hashlib.sha256(content.encode()).hexdigest())
+
+    def artifacts(self, outputs):
+        """
+        Convierte la lista de ficheros de salida de una etapa ('outputs',
+        tuplas (kind, nombre), ver 'EstructuraDirectorios.artifact_path') en
+        la que usa la caché: tuplas (path, nombre en la caché, enlazar).
+        """
+        return([(self.estruct_dir.artifact_path(kind, name), "{}/{}".format(kind, name),
+                 kind == "data") for kind, name in outputs])
+
+    def skip(self, stage, params, outputs):
+        """
+        Indica si la etapa 'stage' se puede saltar. Es así si se está
+        reanudando, no se ha ejecutado ninguna etapa anterior, su clave
+        coincide con la registrada y existen todos sus ficheros de salida
+        ('outputs', ver 'artifacts'); o bien si sus resultados están en la
+        caché, en cuyo caso se recuperan.
+
+        Si no se puede saltar, se eliminan los ficheros de salida que haya de
+        una ejecución anterior: pueden ser enlaces a la caché, y no se deben
+        sobreescribir.
+        """
+        key = self.stage_key(params)
+        self.previous_key = key
+        artifacts = self.artifacts(outputs)
+        self.current = stage
+        self.pending[stage] = (key, params, artifacts)
+
+        record = self.stages.get(stage)
+        if (self.resuming and record is not None and record["key"] == key
+                and all(os.path.exists(path) for path, name, link in artifacts)):
+            print("Etapa '{}' ya completada, se reutilizan sus resultados.".format(stage))
+            return(True)
+
+        self.resuming = False
+
+        if self.use_cache and cache.restore_stage(stage, key, artifacts):
+            print("Etapa '{}' recuperada de la caché.".format(stage))
+            self.record(stage, key, params, artifacts)
+            return(True)
+
+        for path, name, link in artifacts:
+            cache.remove_artifact(path)
+        return(False)
+
+    def complete(self, stage=None):
+        """
+        Registra como completada la etapa 'stage' (por defecto, la última
+        comprobada con 'skip'), y guarda sus ficheros de salida en la caché.
+        Se pueden comprobar varias etapas antes de completarlas, si se
+        ejecutan a la vez (ver 'scheduler').
+        """
+        if stage is None:
+            stage = self.current
+        key, params, artifacts = self.pending.pop(stage)
+        if self.use_cache:
+            cache.store_stage(stage, key, [artifact for artifact in artifacts
+                                           if os.path.exists(artifact[0])])
+        self.record(stage, key, params, artifacts)
+
+    def record(self, stage, key, params, artifacts):
+        """
+        Registra una etapa como completada en 'manifest.json'.
+        """
+        self.stages[stage] = {"key": key, "params": params,
+                              "outputs": [path for path, name, link in artifacts],
+                              "completed": time.strftime("%Y-%m-%d %H:%M:%S")}
+
+        # Se escribe en un fichero temporal y se renombra, para que una
+        # interrupción nunca deje el registro a medio escribir.
+        temp = self.path + ".tmp"
+        with open(temp, 'w') as output:
+            json.dump(self.stages, output, indent=2, sort_keys=True, default=str)
+        os.replace(temp, self.path)
@@ -7,39 +7,125 @@
 import os
 from subprocess import PIPE
 from subprocess import Popen
+from concurrent.futures import ThreadPoolExecutor
 import matplotlib
 import matplotlib.pyplot as plt
+import numpy as np
+
+import alignment
+import blastp
 
 from Bio.Blast import NCBIXML
-from Bio.Align.Applications import MuscleCommandline
 from Bio import Phylo
-from Bio import SeqIO
 
-def multi_align(estruct_dir):
+def run_job(name, command, input=None):
+    """
+    Ejecuta un comando externo, enviándole 'input' (texto) por stdin, y
+    devuelve una tupla (name, código de salida, stderr, stdout), con stdout
+    en bytes. Si el programa no se puede ejecutar, el código es 'None'.
+    """
+    try:
+        process = Popen(command, stdin=PIPE if input is not None else None,
+                        stdout=PIPE, stderr=PIPE)
+        stdout, stderr = process.communicate(input.encode() if input is not None else None)
+        return(name, process.returncode, stderr.decode(errors="replace"), stdout)
+    except OSError as error:
+        return(name, None, str(error), b"")
+
+
+def run_jobs(jobs_list, jobs=1):
     """
-    Hace un alineamiento múltiple de las secuencias contenidas en cada
-    multifasta de la carpeta creada por 'blastp.build_multifasta_for_muscle'.
-    Almacena los resultados en la carpeta 'aligned_matches'.
+    Ejecuta los comandos de 'jobs_list' (lista de tuplas (nombre, comando) o
+    (nombre, comando, stdin)), como máximo 'jobs' a la vez. Cada comando es
+    un subproceso, así que basta con un pool de hilos que espere a que
+    terminen.
+
+    Devuelve los resultados de 'run_job' en el mismo orden que 'jobs_list', e
+    informa por pantalla de los que han fallado.
     """
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        results = list(executor.map(lambda job: run_job(*job), jobs_list))
+
+    for name, returncode, stderr, stdout in results:
+        report_failure(name, returncode, stderr)
+
+    return(results)
 
-    # Crea el directorio de salida del alineamiento.
-    os.mkdir(estruct_dir.file_in_results_dir("aligned_matches"))
 
-    # Recorre los fichero del directoiro 'unaligned_matches'.
-    for filename in os.listdir(estruct_dir.file_in_results_dir("/unaligned_matches")):
+def report_failure(name, returncode, stderr):
+    """
+    Informa por pantalla de un comando que ha fallado (ver 'run_job').
+    """
+    if returncode != 0:
+        print("ERROR: Ha fallado '{}' (código de salida: {}).".format(name, returncode))
+        if stderr.strip():
+            print(stderr.strip())
 
-        try:
-            base_name = "{}_{}".format(filename.split("_")[0], filename.split("_")[1])
 
-            muscle_cline = MuscleCommandline(
-                    input = estruct_dir.file_in_results_dir("/unaligned_matches/{}".format(filename)),
-                    out = estruct_dir.file_in_results_dir("/aligned_matches/{}_aligned.fa".format(base_name)))
+# Comando de MUSCLE: sin '-in' ni '-out', lee el multifasta de stdin y
+# escribe el alineamiento en stdout.
+MUSCLE_COMMAND = ['muscle']
 
-            stdout, stderr = muscle_cline()
 
-        except:
-            # .DS_Store, etc.
-            pass
+def query_of(filename):
+    """
+    Devuelve el id del query ('Q1_nombre') al que corresponde un fichero de
+    resultados ('Q1_nombre_matches.fa', 'Q1_nombre_aligned.fa'...).
+    """
+    return "{}_{}".format(filename.split("_")[0], filename.split("_")[1])
+
+
+def read_alignment(content):
+    """
+    Devuelve una lista de tuplas (id, secuencia alineada) con los registros
+    de un alineamiento en formato FASTA ('content', en bytes), en el mismo
+    orden. Las secuencias alineadas se devuelven en bytes (ver
+    'blastp.alignment_bytes'), sin construir objetos 'Seq'.
+    """
+    records = []
+    for line in content.splitlines():
+        if line.startswith(b">"):
+            # Como en BioPython, el id es la primera palabra del header.
+            header = line[1:].split(None, 1)
+            records.append((header[0].decode() if header else "", []))
+        elif records:
+            records[-1][1].append(line.strip())
+    return([(record_id, b"".join(lines)) for record_id, lines in records])
+
+
+def export_alignment(estruct_dir, query, content):
+    """
+    Guarda el alineamiento de un query ('content', en bytes) en
+    'aligned_matches/<query>_aligned.fa'.
+    """
+    os.makedirs(estruct_dir.file_in_results_dir("aligned_matches"), exist_ok=True)
+    with open(estruct_dir.file_in_results_dir("aligned_matches/{}_aligned.fa".format(query)), 'wb') as out:
+        out.write(content)
+
+
+def multi_align(estruct_dir, fastas, jobs=1, export=False):
+    """
+    Hace un alineamiento múltiple de las secuencias de cada multifasta de
+    'fastas' (diccionario query -> multifasta, ver
+    'blastp.build_multifasta_for_muscle'). Cada multifasta se envía a MUSCLE
+    por stdin y el alineamiento se lee de stdout, sin ficheros intermedios;
+    con 'export', los alineamientos se guardan además en la carpeta
+    'aligned_matches'.
+
+    Se ejecutan hasta 'jobs' alineamientos a la vez. Devuelve un
+    diccionario query -> alineamiento (ver 'read_alignment') con los que no
+    han fallado.
+    """
+    jobs_list = [(query, MUSCLE_COMMAND, fasta) for query, fasta in fastas.items()]
+
+    alignments = {}
+    for query, returncode, stderr, stdout in run_jobs(jobs_list, jobs):
+        if returncode == 0:
+            alignments[query] = read_alignment(stdout)
+            if export:
+                export_alignment(estruct_dir, query, stdout)
+
+    return(alignments)
 
 class Query:
     """
@@ -47,18 +133,43 @@ class Query:
     para graficar más tarde.
     """
 
-    def __init__(self, id, aligned_seq):
+    def __init__(self, id, aligned_seq, records=()):
         self.id = id
         self.aligned_seq = aligned_seq
+        # Ids de los registros del alineamiento, en el orden de MUSCLE.
+        self.records = list(records)
         self.non_gapped = []
+        self.domains = []
         self.aligned_domains = []
+        # Estadísticas de cada columna del alineamiento (ver
+        # 'alignment.column_statistics').
+        self.occupancy = None
+        self.consensus = None
+        self.identity = None
 
-    def ilustrate_alignment(self, start, end):
+    def ilustrate_alignment(self, runs):
         """
         Recoge las regiones de la secuencia que no son gaps en el alineamiento
-        (que no son guiones).
+        (que no son guiones), a partir de un array (n, 2) con su inicio y su
+        final (ver 'alignment.non_gapped_runs').
+        """
+        self.non_gapped = [tuple(run) for run in runs.tolist()]
+
+    def add_column_statistics(self, occupancy, consensus, identity):
+        """
+        Recoge las estadísticas de cada columna del alineamiento del query
+        (ver 'alignment.column_statistics'), para después graficarlas.
+        """
+        self.occupancy = occupancy
+        self.consensus = consensus
+        self.identity = identity
+
+    def add_domain(self, accession, start, end):
+        """
+        Recoge un dominio conservado detectado en la secuencia del query (sin
+        guiones).
         """
-        self.non_gapped.append((start,end))
+        self.domains.append((accession, start, end))
 
     def add_aligned_domain(self, accession, start, end):
         """
@@ -68,71 +179,251 @@ class Query:
         self.aligned_domains.append((accession, start, end))
 
 
-def parse_alignment(estruct_dir, proteins):
+def read_exported_alignments(estruct_dir, selection=None):
     """
-    Parsea el resultado del alineamiento, e incorpora a las instancias de la
-    clase Protein las secuencias con los gaps necesarios para cuadrar el
-    alineamiento.
+    Lee los alineamientos guardados en la carpeta 'aligned_matches' (ver
+    'export_alignment'), de los queries de 'selection' si se indica. Devuelve
+    un diccionario query -> alineamiento (ver 'read_alignment').
     """
-
     path = estruct_dir.file_in_results_dir("aligned_matches")
 
-    queries = []
-
+    alignments = {}
     for filename in os.listdir(path):
         # Recorre los archivos del directorio.
-        query_id = filename.split("_")[0] + "_" + filename.split("_")[1]
-        with open(path+"/"+filename) as input_handle:
-            for record in SeqIO.parse(input_handle, "fasta"):
-                for protein in proteins:
-                    if protein.query_id == query_id:
-                        if protein.subject_id == record.id:
-                            protein.add_alignment(record.seq)
-
-                if record.id == query_id:
-                    queries.append(Query(record.id, record.seq))
+        query_id = query_of(filename)
+        if selection is not None and query_id not in selection:
+            continue
+        with open(path+"/"+filename, 'rb') as input_handle:
+            alignments[query_id] = read_alignment(input_handle.read())
+    return(alignments)
+
+
+def parse_alignment(estruct_dir, proteins, selection=None, alignments=None):
+    """
+    Parsea el resultado del alineamiento ('alignments', ver 'multi_align';
+    si no se indica, los de la carpeta 'aligned_matches'), e incorpora a las
+    instancias de la clase Protein las secuencias con los gaps necesarios
+    para cuadrar el alineamiento. Si se indica 'selection', sólo se procesan
+    los alineamientos de esos queries.
+
+    El query de cada alineamiento es el registro cuyo id es el de un query
+    (no se deduce del nombre del fichero). Los resultados se localizan con
+    un índice (query, subject), así que cada alineamiento se incorpora en
+    tiempo lineal.
+    """
+    if alignments is None:
+        alignments = read_exported_alignments(estruct_dir)
+
+    # Resultados de cada par (query, subject): puede haber varios, si el
+    # BLAST encuentra varios HSPs del mismo subject.
+    index = {}
+    for protein in proteins:
+        index.setdefault((protein.query_id, protein.subject_id), []).append(protein)
+    query_ids = {query_id for query_id, subject_id in index}
+
+    queries = []
+
+    for records in alignments.values():
+        query_record = next((record for record in records if record[0] in query_ids), None)
+        if query_record is None:
+            continue
+        query_id = query_record[0]
+        if selection is not None and query_id not in selection:
+            continue
+
+        for record_id, aligned_seq in records:
+            for protein in index.get((query_id, record_id), ()):
+                protein.add_alignment(aligned_seq)
+
+        queries.append(Query(query_id, blastp.alignment_bytes(query_record[1]),
+                             [record_id for record_id, aligned_seq in records]))
     return(queries)
 
-def build_tree(estruct_dir):
+
+def stored_alignments(estruct_dir, queries, proteins):
     """
-    Construye árbol filogenético en formato NW.
+    Reconstruye el alineamiento de cada query de 'queries' (instancias de
+    'Query') a partir de las secuencias alineadas guardadas en él y en los
+    resultados de 'proteins', en el orden de MUSCLE. Devuelve un diccionario
+    query -> alineamiento (ver 'read_alignment').
+
+    Los proyectos anteriores no guardan el orden del alineamiento: en ellos
+    se lee de la carpeta 'aligned_matches'.
     """
+    aligned = {}
+    for protein in proteins:
+        if protein.aligned_seq is not None:
+            aligned.setdefault(protein.query_id, {})[protein.subject_id] = \
+                    blastp.alignment_bytes(protein.aligned_seq)
+
+    alignments = {}
+    for query in queries:
+        records = getattr(query, "records", None)
+        if not records:
+            alignments.update(read_exported_alignments(estruct_dir, {query.id}))
+            continue
+        rows = aligned.get(query.id, {})
+        rows[query.id] = blastp.alignment_bytes(query.aligned_seq)
+        alignments[query.id] = [(record_id, rows[record_id])
+                                for record_id in records if record_id in rows]
+    return(alignments)
+
+def distance_matrix(matrix, method="kimura"):
+    """
+    Calcula la matriz de distancias entre todas las secuencias del
+    alineamiento codificado 'matrix' (ver 'alignment.encode_alignment').
 
-    # Crea el directorio de salida.
-    os.mkdir(estruct_dir.file_in_results_dir("trees_nw"))
+    La p-distancia es la proporción de posiciones distintas entre las
+    posiciones donde ninguna de las dos secuencias tiene gap. Con
+    'method="kimura"' se aplica la corrección de Kimura para proteínas:
+    d = -ln(1 - p - 0.2·p²).
+    """
+    n = matrix.shape[0]
+    valid = matrix != alignment.GAP
+    p = np.zeros((n, n))
+
+    for i in range(n):
+        # Fila 'i' contra todas las demás a la vez.
+        compared = valid[i] & valid
+        same = (matrix[i] == matrix) & compared
+        n_compared = compared.sum(axis=1)
+        n_same = same.sum(axis=1)
+        # Sin posiciones comparables, se considera la distancia máxima.
+        p[i] = np.where(n_compared > 0, 1 - n_same / np.maximum(n_compared, 1), 1.0)
+
+    np.fill_diagonal(p, 0)
 
-    # Recorre los fichero del directoiro 'unaligned_matches'.
-    for filename in os.listdir(estruct_dir.file_in_results_dir("/aligned_matches")):
+    if method == "kimura":
+        # Para p >= ~0.85 la corrección no está definida: se satura.
+        argument = np.clip(1 - p - 0.2 * p**2, 1e-6, None)
+        return(-np.log(argument))
+    return(p)
 
-        try:
 
-            input = estruct_dir.file_in_results_dir("/aligned_matches/{}".format(filename))
+def neighbor_joining(names, distances):
+    """
+    Construye un árbol por neighbor-joining a partir de la matriz de
+    distancias 'distances' (NumPy) entre las secuencias 'names'. Devuelve el
+    árbol en formato Newick.
+    """
+    nodes = list(names)
+    D = np.array(distances, dtype=float)
 
-            base_name = filename.split("_")[0]
+    if len(nodes) == 0:
+        return(";")
+    if len(nodes) == 1:
+        return("{};".format(nodes[0]))
 
-            output = estruct_dir.file_in_results_dir("/trees_nw/{}_tree.nw".format(base_name))
+    while len(nodes) > 2:
+        n = len(nodes)
+        totals = D.sum(axis=1)
 
-            process = Popen(
-                    ['muscle', '-in', input, '-out', output, '-maketree', '-cluster', 'neighborjoining'],
-                    stdout=PIPE,
-                    stderr=PIPE)
+        # Matriz Q: se unen los dos nodos con menor valor.
+        Q = (n - 2) * D - totals[:, None] - totals[None, :]
+        np.fill_diagonal(Q, np.inf)
+        i, j = np.unravel_index(np.argmin(Q), Q.shape)
 
-            stdout, stderr = process.communicate()
+        length_i = 0.5 * D[i, j] + (totals[i] - totals[j]) / (2 * (n - 2))
+        length_j = D[i, j] - length_i
+        length_i, length_j = max(0.0, length_i), max(0.0, length_j)
 
-        except:
-            # .DS_Store, etc.
-            pass
+        new_node = "({}:{:.5f},{}:{:.5f})".format(nodes[i], length_i,
+                                                  nodes[j], length_j)
+        new_distances = 0.5 * (D[i] + D[j] - D[i, j])
 
-def plot_tree(estruct_dir):
+        # Sustituye los nodos 'i' y 'j' por el nuevo nodo.
+        keep = [k for k in range(n) if k != i and k != j]
+        D = np.vstack([
+                np.hstack([D[np.ix_(keep, keep)], new_distances[keep][:, None]]),
+                np.append(new_distances[keep], 0)])
+        nodes = [nodes[k] for k in keep] + [new_node]
+
+    half = max(0.0, D[0, 1]) / 2
+    return("({}:{:.5f},{}:{:.5f});".format(nodes[0], half, nodes[1], half))
+
+
+def subset_alignment(estruct_dir, query, proteins, export=False):
+    """
+    Elimina de un alineamiento ya hecho las proteínas que ya no están entre
+    los resultados del query, sin volver a alinear: las filas del resto de
+    proteínas y del query se mantienen, quitando las columnas que quedan
+    sólo con gaps. Actualiza el alineamiento de las instancias de
+    'proteins' (los resultados que se mantienen) y, con 'export', el fichero
+    'aligned_matches/<query>_aligned.fa'. Devuelve el nuevo 'Query', con los
+    dominios del anterior.
+    """
+    kept = {protein.subject_id for protein in proteins}
+    records = [(record_id, aligned_seq) for record_id, aligned_seq
+               in stored_alignments(estruct_dir, [query], proteins)[query.id]
+               if record_id in kept or record_id == query.id]
+
+    matrix = alignment.encode_alignment([aligned_seq for record_id, aligned_seq in records])
+    columns = np.nonzero((matrix != alignment.GAP).any(axis=0))[0]
+    aligned = {record_id: row[columns].tobytes()
+               for (record_id, aligned_seq), row in zip(records, matrix)}
+
+    if export:
+        export_alignment(estruct_dir, query.id, b"".join(
+                b">%s\n%s\n" % (record_id.encode(), aligned[record_id])
+                for record_id, aligned_seq in records))
+
+    for protein in proteins:
+        protein.reset_alignment()
+        protein.add_alignment(aligned[protein.subject_id])
+
+    subset = Query(query.id, aligned[query.id], [record_id for record_id, aligned_seq in records])
+    subset.domains = list(query.domains)
+    return(subset)
+
+
+def build_tree(estruct_dir, method="kimura", queries=None, alignments=None):
+    """
+    Construye árbol filogenético en formato NW, por neighbor-joining a partir
+    de cada alineamiento de 'alignments' (ver 'multi_align' y
+    'stored_alignments'; si no se indica, los de la carpeta
+    'aligned_matches'). Ver 'distance_matrix' y 'neighbor_joining'. Si se
+    indica 'queries', sólo los de esos queries.
+    """
+    if alignments is None:
+        alignments = read_exported_alignments(estruct_dir, queries)
+
+    # Crea el directorio de salida.
+    os.makedirs(estruct_dir.file_in_results_dir("trees_nw"), exist_ok=True)
+
+    for query_id in sorted(alignments):
+        if queries is not None and query_id not in queries:
+            continue
+
+        records = alignments[query_id]
+        base_name = query_id.split("_")[0]
+
+        output = estruct_dir.file_in_results_dir("trees_nw/{}_tree.nw".format(base_name))
+
+        matrix = alignment.encode_alignment([aligned_seq for record_id, aligned_seq in records])
+        distances = distance_matrix(matrix, method)
+        newick = neighbor_joining([record_id for record_id, aligned_seq in records], distances)
+
+        with open(output, 'w') as out:
+            out.write(newick + "\n")
+
+def plot_tree(estruct_dir, queries=None):
     """
     Genera una representación gráfica del árbol en formato PDF a partir del
-    fichero .nw que crea MUSCLE.
+    fichero .nw que crea MUSCLE. Si se indica 'queries', sólo los de esos
+    queries.
     """
 
     source = estruct_dir.file_in_results_dir("trees_nw")
-    os.mkdir(estruct_dir.file_in_results_dir("trees_plot"))
+    os.makedirs(estruct_dir.file_in_results_dir("trees_plot"), exist_ok=True)
+
+    # Los ficheros de los árboles sólo llevan el índice del query ('Q1').
+    indexes = None
+    if queries is not None:
+        indexes = {query.split("_")[0] for query in queries}
 
     for filename in os.listdir(source):
+        if indexes is not None and filename.split("_")[0] not in indexes:
+            continue
 
         out = estruct_dir.file_in_results_dir("trees_plot")
         base_name = filename.split("_")[0]
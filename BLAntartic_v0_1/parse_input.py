@@ -8,51 +8,349 @@
 import sys
 import os
 import shutil
+import pickle
+import hashlib
 
 import re
 from Bio import Seq
 from Bio import SeqIO
 
+import cache
+import gbscan
+import pool
 
-def make_genomes_multifasta(folder_path, estruct_dir):
+
+class SequenceStore:
+    """
+    Índice de acceso directo a las secuencias de un fichero multifasta.
+
+    Para cada identificador ('locus_tag@especie' en el caso de los genomas)
+    almacena la posición (en bytes) en la que empieza su secuencia dentro del
+    fichero y su longitud, de forma que recuperar una secuencia no requiere
+    volver a parsear el multifasta completo.
+    """
+
+    def __init__(self, fasta_path):
+        self.fasta_path = fasta_path
+        self.offsets = {}
+        self._handle = None
+
+    def add(self, seq_id, offset, length):
+        """
+        Registra la posición y longitud de la secuencia 'seq_id'.
+        """
+        self.offsets[seq_id] = (offset, length)
+
+    def __contains__(self, seq_id):
+        return seq_id in self.offsets
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def get(self, seq_id):
+        """
+        Devuelve la secuencia correspondiente a 'seq_id', leyendo únicamente
+        los bytes que ocupa en el fichero.
+        """
+        offset, length = self.offsets[seq_id]
+        if self._handle is None:
+            self._handle = open(self.fasta_path, 'rb')
+        self._handle.seek(offset)
+        return self._handle.read(length).decode()
+
+    def close(self):
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
+
+    def __getstate__(self):
+        # El fichero abierto no se puede serializar.
+        state = self.__dict__.copy()
+        state['_handle'] = None
+        return state
+
+    def save(self, path):
+        """
+        Guarda el índice en disco, para poder reutilizarlo al reabrir el
+        proyecto.
+        """
+        with open(path, 'wb') as output:
+            pickle.dump(self, output, pickle.HIGHEST_PROTOCOL)
+
+
+def write_fasta_record(handle, seq_id, sequence, offset, store):
+    """
+    Escribe un registro en formato FASTA en 'handle' y lo registra en
+    'store'. 'offset' es la posición en bytes en la que empieza el registro;
+    devuelve la posición en la que termina.
+
+    'handle' se abre en modo binario ('wb'), y el registro se escribe en
+    UTF-8, que es como lo lee 'SequenceStore.get': en modo texto, la
+    codificación y los saltos de línea dependerían de la plataforma, y las
+    posiciones no coincidirían con las del fichero.
+    """
+    header = ">{}\n".format(seq_id).encode()
+    sequence = sequence.encode()
+    handle.write(header)
+    handle.write(sequence)
+    handle.write(b"\n\n")
+
+    seq_offset = offset + len(header)
+    seq_length = len(sequence)
+    store.add(seq_id, seq_offset, seq_length)
+
+    return(seq_offset + seq_length + 2)
+
+
+def load_sequence_store(path):
+    """
+    Recupera un índice de secuencias guardado con 'SequenceStore.save'.
+
+    El multifasta se busca junto al índice, y no en el path con el que se
+    guardó: el índice puede venir de la caché de otro proyecto (ver
+    'cache.restore_stage').
+    """
+    with open(path, 'rb') as input:
+        store = pickle.load(input)
+    store.fasta_path = os.path.join(os.path.dirname(path),
+                                    os.path.basename(store.fasta_path))
+    return(store)
+
+
+# Versión del formato de los proteomas guardados en la caché. Si cambia la
+# forma de extraerlos, se debe incrementar para no reutilizar los antiguos.
+PROTEOME_CACHE_VERSION = 4
+
+
+def parse_genome(path, backend="fast"):
+    """
+    Parsea un GB y devuelve una tupla (nombre_corto, records), donde
+    'nombre_corto' es la especie (binomial, con guión bajo) y 'records' una
+    lista de tuplas (id, secuencia, anotación) con las proteínas de sus CDSs.
+    El id tiene el formato 'locus_tag@especie', y la anotación es una tupla
+    (localización, número EC, producto), con "N/A" en los campos que falten.
+
+    Con 'backend="fast"' se usa el lector de 'gbscan', que sólo procesa la
+    tabla de features; con 'backend="biopython"', 'SeqIO.parse'. Los dos
+    extraen los mismos CDSs, con las localizaciones en el formato de
+    BioPython; 'gbscan.compare_with_biopython' comprueba que coinciden en un
+    fichero concreto.
+    """
+    records = []
+    nombre_corto = None
+
+    with open(path, "r") as input_handle:
+        if backend == "biopython":
+            for record in SeqIO.parse(input_handle, "genbank"):
+                # Extrae el nombre de la especie (bionmial) y sustituye
+                # espacios por guiones bajos.
+                nombre_largo = record.description.split()
+                nombre_corto = nombre_largo[0] + "_" + nombre_largo[1]
+
+                for feature in record.features:
+                    if feature.type == 'CDS':
+                        try:
+                            seq_id = "{}@{}".format(feature.qualifiers['locus_tag'][0], nombre_corto)
+                            sequence = feature.qualifiers['translation'][0]
+                        except:
+                            continue
+                        annotation = (str(feature.location),
+                                      feature.qualifiers.get('EC_number', ["N/A"])[0],
+                                      feature.qualifiers.get('product', ["N/A"])[0])
+                        records.append((seq_id, sequence, annotation))
+        else:
+            for description, cds_list in gbscan.scan_records(input_handle):
+                nombre_largo = description.split()
+                nombre_corto = nombre_largo[0] + "_" + nombre_largo[1]
+
+                for cds in cds_list:
+                    if 'locus_tag' in cds and 'translation' in cds:
+                        seq_id = "{}@{}".format(cds['locus_tag'], nombre_corto)
+                        annotation = (cds['location'],
+                                      cds.get('EC_number', "N/A"),
+                                      cds.get('product', "N/A"))
+                        records.append((seq_id, cds['translation'], annotation))
+
+    if nombre_corto is None:
+        raise ValueError("'{}' no contiene ningún record GeneBank.".format(path))
+
+    return(nombre_corto, records)
+
+
+def ingest_genome(path, backend="fast"):
+    """
+    Extrae el proteoma de un GB y lo guarda en la caché, en formato FASTA
+    ('<hash>.fa') junto con un índice ('<hash>.idx') con la especie, la
+    posición de cada secuencia y la anotación de cada CDS. El hash es el del
+    contenido del fichero, así que un genoma ya procesado (en este u otro
+    proyecto) no se vuelve a parsear. Los proteomas de cada lector
+    ('backend') se guardan por separado, para que '--gb-parser' nunca
+    reutilice los del otro.
+
+    Devuelve una tupla (path, prefijo de los ficheros en la caché), o 'None'
+    si el fichero no se puede parsear.
+    """
+    prefix = "{}/{}_v{}_{}".format(cache.cache_dir("proteomes"),
+                                   cache.hash_file(path),
+                                   PROTEOME_CACHE_VERSION, backend)
+
+    if os.path.exists(prefix + ".idx"):
+        cache.touch(prefix + ".fa")
+        cache.touch(prefix + ".idx")
+        return(path, prefix)
+
+    try:
+        nombre_corto, records = parse_genome(path, backend)
+    except:
+        # Si el parser no puede abrir el archivo...
+        return(None)
+
+    # Se escribe en ficheros temporales y se renombran al final, para que
+    # otro proceso nunca encuentre un proteoma a medio escribir.
+    temp = "{}.{}.tmp".format(prefix, os.getpid())
+    store = SequenceStore(prefix + ".fa")
+    annotations = {}
+    offset = 0
+    with open(temp, 'wb') as handle:
+        for seq_id, sequence, annotation in records:
+            offset = write_fasta_record(handle, seq_id, sequence, offset, store)
+            annotations[seq_id] = annotation
+    os.replace(temp, prefix + ".fa")
+
+    with open(temp, 'wb') as output:
+        pickle.dump((nombre_corto, store.offsets, annotations),
+                    output, pickle.HIGHEST_PROTOCOL)
+    os.replace(temp, prefix + ".idx")
+
+    return(path, prefix)
+
+
+def make_genomes_multifasta(folder_path, estruct_dir, workers=1, backend="fast", dedup=False):
     """
     Parsea todos los GBs contenido en la carpeta 'folder_path', extrae las
     secuencias de proteína de sus CDSs y econstruye un multifasta conjunto.
 
     En el header de cada secuencia del MULTIFASTA, incluye el nombre del gen,
     así como la especie del GB de donde se ha estraído (separado por '@').
+
+    Los GBs se procesan en paralelo ('workers' procesos), y el proteoma de
+    cada uno se guarda en la caché (ver 'ingest_genome'); el multifasta se
+    construye concatenando esos proteomas. 'backend' indica el lector de
+    GeneBank que se utiliza (ver 'parse_genome').
+
+    Devuelve un 'SequenceStore' con la posición de cada secuencia dentro del
+    multifasta, que también se guarda en la carpeta de datos
+    ('genomes_index.pkl'). Además, guarda en esa misma carpeta la anotación
+    de cada CDS ('genomes_annotations.pkl', ver 'load_annotations').
+
+    Con 'dedup=True', las proteínas con la misma secuencia (p. ej. de cepas
+    muy próximas) sólo se escriben una vez en el multifasta, con el id de la
+    primera que aparece (representante). En el 'SequenceStore' todos los ids
+    apuntan a la secuencia del representante, y la lista de miembros de cada
+    grupo se guarda en 'genomes_members.pkl' (ver 'load_members').
     """
+    paths = cache.list_files(folder_path)
+
+    if workers > 1 and len(paths) > 1:
+        with pool.process_pool(workers) as executor:
+            ingested = list(executor.map(ingest_genome, paths,
+                                         [backend] * len(paths)))
+    else:
+        ingested = [ingest_genome(path, backend) for path in paths]
+
     multifasta_path = estruct_dir.file_in_data_dir('genomes_multifasta.fa')
-    multifasta = open(multifasta_path, 'a')
+    store = SequenceStore(multifasta_path)
+    annotations = {}
 
     destination_path = estruct_dir.file_in_data_dir("raw_GBs/")
-    os.mkdir(destination_path)
+    os.makedirs(destination_path, exist_ok=True)
 
-    genomes_dict = {}
+    # Para cada secuencia distinta (por su hash), el id de su representante.
+    representatives = {}
+    members = {}
 
-    for filename in os.listdir(folder_path):
-        try:
-            with open("{}/{}".format(folder_path, filename), "r") as input_handle:
-
-                for record in SeqIO.parse(input_handle, "genbank"):
-                    # Extrae el nombre de la especie (bionmial) y sustituye
-                    # espacios por guiones bajos.
-                    nombre_largo = record.description.split()
-                    nombre_corto = nombre_largo[0] + "_" + nombre_largo[1]
-
-                    # Construye el MULTIFASTA.
-                    for feature in record.features:
-                        if feature.type == 'CDS':
-                            try:
-                                multifasta.write(">{}@{}\n{}\n\n".format(feature.qualifiers['locus_tag'][0],nombre_corto, feature.qualifiers['translation'][0]))
-                            except:
-                                pass
-                shutil.copy2("{}/{}".format(folder_path, filename),
-                              destination_path+"/"+nombre_corto+".gbff")
-        except:
-            # Si el parser de BioPy no puede abrir el archivo...
-            pass
-    multifasta.close()
+    with open(multifasta_path, 'wb') as multifasta:
+        for result in ingested:
+            if result is None:
+                continue
+            path, prefix = result
+
+            with open(prefix + ".idx", 'rb') as input:
+                nombre_corto, offsets, genome_annotations = pickle.load(input)
+            annotations.update(genome_annotations)
+
+            if not dedup:
+                # Añade el proteoma al multifasta, desplazando su índice.
+                base = multifasta.tell()
+                with open(prefix + ".fa", 'rb') as proteome:
+                    shutil.copyfileobj(proteome, multifasta)
+                for seq_id, (offset, length) in offsets.items():
+                    store.add(seq_id, base + offset, length)
+
+            else:
+                with open(prefix + ".fa", 'rb') as proteome:
+                    content = proteome.read()
+                for seq_id, (offset, length) in offsets.items():
+                    if seq_id in store.offsets:
+                        # Id repetido (p. ej. dos GBs de la misma especie):
+                        # ya está en el multifasta, o como miembro de un
+                        # grupo. Si no se omitiera, el representante podría
+                        # quedar como miembro de sí mismo.
+                        continue
+                    sequence = content[offset:offset+length]
+                    digest = hashlib.sha256(sequence).digest()
+                    if digest in representatives:
+                        # Secuencia repetida: sólo se registra como miembro.
+                        representative = representatives[digest]
+                        store.add(seq_id, *store.offsets[representative])
+                        members[representative].append(seq_id)
+                    else:
+                        representatives[digest] = seq_id
+                        members[seq_id] = []
+                        header = ">{}\n".format(seq_id).encode()
+                        multifasta.write(header)
+                        store.add(seq_id, multifasta.tell(), length)
+                        multifasta.write(sequence + b"\n\n")
+
+            shutil.copy2(path, destination_path+"/"+nombre_corto+".gbff")
+
+    store.save(estruct_dir.file_in_data_dir('genomes_index.pkl'))
+
+    with open(estruct_dir.file_in_data_dir('genomes_annotations.pkl'), 'wb') as output:
+        pickle.dump(annotations, output, pickle.HIGHEST_PROTOCOL)
+
+    if dedup:
+        # Sólo se guardan los grupos con más de una proteína.
+        members = {representative: group for representative, group
+                   in members.items() if group}
+        with open(estruct_dir.file_in_data_dir('genomes_members.pkl'), 'wb') as output:
+            pickle.dump(members, output, pickle.HIGHEST_PROTOCOL)
+
+    return(store)
+
+
+def load_annotations(estruct_dir):
+    """
+    Recupera el diccionario que relaciona cada 'locus_tag@especie' con la
+    anotación de su CDS (localización, número EC, producto), guardado por
+    'make_genomes_multifasta'.
+    """
+    with open(estruct_dir.file_in_data_dir('genomes_annotations.pkl'), 'rb') as input:
+        return(pickle.load(input))
+
+
+def load_members(estruct_dir):
+    """
+    Recupera el diccionario que relaciona el id de cada representante con
+    la lista de ids (sin incluirlo a él) de las proteínas con su misma
+    secuencia, guardado por 'make_genomes_multifasta' con 'dedup=True'.
+    Si el proyecto no se ha hecho en ese modo, devuelve un diccionario vacío.
+    """
+    path = estruct_dir.file_in_data_dir('genomes_members.pkl')
+    if not os.path.exists(path):
+        return({})
+    with open(path, 'rb') as input:
+        return(pickle.load(input))
 
 
 def store_GBs_copies(folder_path, estruct_dir):
@@ -65,7 +363,7 @@ def store_GBs_copies(folder_path, estruct_dir):
     """
 
     destination_path = estruct_dir.file_in_data_dir("raw_GBs/")
-    os.mkdir(destination_path)
+    os.makedirs(destination_path, exist_ok=True)
 
     for filename in os.listdir(folder_path):
         origin = folder_path + "/" + filename
@@ -78,13 +376,15 @@ def preprocess_queries(query_multifasta, estruct_dir):
     los 6 primeros caracteres coincidan en varios queries.
 
     Crea un farchivo multifasta con estas modificaciones en la carpeta de
-    'data'.
+    'data'. Devuelve un 'SequenceStore' con la posición de cada query en ese
+    fichero, que también se guarda en esa carpeta ('queries_index.pkl').
     """
 
     out_path = estruct_dir.file_in_data_dir("queries.fa")
-    out = open(out_path, 'w')
+    out = open(out_path, 'wb')
 
-    queries = []
+    queries = SequenceStore(out_path)
+    offset = 0
 
     with open(query_multifasta, "r") as input_handle:
         record_index = 1
@@ -97,17 +397,29 @@ def preprocess_queries(query_multifasta, estruct_dir):
 
             if len(clean_header) > 6:
                 clean_header = clean_header[0:6]
-            header1 = ">Q"+str(record_index) +"_"+ clean_header
-            out.write(header1+"\n")
-            out.write(sequence+"\n\n")
+            header1 = "Q"+str(record_index) +"_"+ clean_header
+            offset = write_fasta_record(out, header1, sequence, offset, queries)
 
 
             record_index += 1
     out.close()
 
+    queries.save(estruct_dir.file_in_data_dir("queries_index.pkl"))
+
     return(queries)
 
 
+def load_queries(estruct_dir):
+    """
+    Recupera las secuencias de los queries del fichero 'queries.fa' de la
+    carpeta de datos (ver 'preprocess_queries'), en un diccionario
+    {id: secuencia}.
+    """
+    with open(estruct_dir.file_in_data_dir("queries.fa"), 'r') as input_handle:
+        return({record.id: str(record.seq)
+                for record in SeqIO.parse(input_handle, "fasta")})
+
+
 def check_dbs():
     """
     Comprueba que los ficheros de la base de datos PROSITE están contenidos en
@@ -7,19 +7,23 @@
 
 import sys
 import os
-import re
 
 import matplotlib
 import matplotlib.pyplot as plt
 import matplotlib.patches as patches
 import matplotlib.image as mpimg
 from matplotlib.widgets import Button
-matplotlib.use('TkAgg')
+import numpy as np
+# Si se indica otro backend con MPLBACKEND (p. ej. 'Agg', para ejecutar sin
+# pantalla, ver 'check_pipeline.py'), se respeta.
+if "MPLBACKEND" not in os.environ:
+    matplotlib.use('TkAgg')
 
 from Bio import Seq
 from Bio import SeqIO
 
-from blastp import Protein
+from blastp import Protein, alignment_bytes
+import alignment
 import prosite
 import infowindow
 
@@ -103,61 +107,117 @@ def plot_spacer(x1, x2, y1, ax, color="grey"):
     return(x1+width)
 
 
-def search_aligned_domains(dict_pattern, proteins, queries, threshold=8):
+def column_map(aligned_seq):
     """
-    Busca dominios conservados en la secuencia ALINEADA de cada una de las
-    proteínas (es decir, secuencias que incluyen gaps resultantes del
-    alineamiento). De esta manera, se calcula la posición de dichos dominios
-    dentro de la representación que se va a hacer.
+    Devuelve, para cada residuo de la secuencia original (sin gaps), la
+    columna del alineamiento en la que se encuentra.
+    """
+    return([column for column, residue in enumerate(alignment_bytes(aligned_seq))
+            if residue != ord("-")])
+
+
+def map_aligned_domains(proteins, queries, threshold=8):
+    """
+    Calcula la posición de los dominios conservados (ya encontrados sobre la
+    secuencia original de cada proteína, ver 'prosite.search_domains')
+    dentro de la secuencia ALINEADA (es decir, incluyendo los gaps resultantes
+    del alineamiento), que es la que se va a representar.
+
+    Un dominio interrumpido por gaps se representa desde la columna de su
+    primer residuo hasta la de su último residuo.
 
     El parámetro 'threshold' permite excluir dominios muy pequeños, para que
     el gráfico no esté demasiado recargado.
     """
 
-    # Para los subjects
-    for protein in proteins:
-        for pattern in list(dict_pattern.keys()):
-            matches = re.finditer(pattern, str(protein.aligned_seq))
-            for match in matches:
-                match_length = match.end() - match.start()
-                if match_length > threshold:
-                    # Almacena resultado en la misma instancia de donde
-                    # se ha obtenido la secuencia.
-                    protein.add_aligned_domain(
-                            dict_pattern[pattern],
-                            match.start(),
-                            match.end()
-                            )
-
-    # Para el query, ídem.
-    for protein in queries:
-        for pattern in list(dict_pattern.keys()):
-            matches = re.finditer(pattern, str(protein.aligned_seq))
-            for match in matches:
-                match_length = match.end() - match.start()
-                if match_length > threshold:
-                    protein.add_aligned_domain(
-                            dict_pattern[pattern],
-                            match.start(),
-                            match.end()
-                            )
-
-
-def analyze_alignment(proteins):
+    # Subjects y queries se tratan igual.
+    for instance in list(proteins) + list(queries):
+        if getattr(instance, "aligned_seq", None) is None:
+            # Sin alineamiento, no hay nada que ubicar.
+            continue
+
+        columns = column_map(instance.aligned_seq)
+        for accession, start, end in instance.domains:
+            if end - start > threshold:
+                instance.add_aligned_domain(
+                        accession,
+                        columns[start],
+                        columns[end-1] + 1
+                        )
+
+
+def analyze_alignment(proteins, queries):
     """
-    Determina qué regiones de la secuencia alineada de cada proteína son
-    aminoácidos y qué regiones son gaps del alineamiento (guiones).
+    Determina qué regiones de la secuencia alineada de cada proteína y de
+    cada query son aminoácidos y qué regiones son gaps del alineamiento
+    (guiones), y calcula las estadísticas de cada columna del alineamiento
+    de cada query (ver 'alignment.column_statistics').
+
+    Cada alineamiento se procesa de una vez, como una matriz (una fila por
+    subject y otra para el query, ver 'alignment.encode_alignment').
     """
+    aligned = {}
     for protein in proteins:
-        matches = re.finditer(r"[A-Z]+", str(protein.aligned_seq))
-        for match in matches:
-            protein.ilustrate_alignment(match.start(), match.end())
+        if protein.aligned_seq is None:
+            # Resultado no alineado (ver '--max-aligned').
+            continue
+        # Los resultados del mismo subject (varios HSPs) comparten fila.
+        aligned.setdefault(protein.query_id, {}).setdefault(protein.subject_id, []).append(protein)
+
+    for query in queries:
+        subjects = aligned.get(query.id, {})
+        rows = [query.aligned_seq] + [instances[0].aligned_seq for instances in subjects.values()]
+        matrix = alignment.encode_alignment(rows)
+
+        runs = alignment.non_gapped_runs(matrix)
+        query.ilustrate_alignment(runs[0])
+        for instances, subject_runs in zip(subjects.values(), runs[1:]):
+            for protein in instances:
+                protein.ilustrate_alignment(subject_runs)
+
+        query.add_column_statistics(*alignment.column_statistics(matrix, 0))
+
+
+def plot_column_statistics(query, y1, ax):
+    """
+    Representa, sobre el query, la identidad de cada columna del alineamiento
+    con el query (área azul) y su ocupación (línea gris), ver
+    'alignment.column_statistics'. Devuelve los límites (en y) de la banda,
+    o 'None' si el query no tiene estadísticas (proyectos anteriores).
+    """
+    if getattr(query, "identity", None) is None or len(query.identity) == 0:
+        return(None)
+
+    height = 0.3
+    x = np.arange(len(query.identity) + 1)
+    # Con 'step="post"', cada valor se extiende hasta la columna siguiente.
+    identity = np.append(query.identity, query.identity[-1])
+    occupancy = np.append(query.occupancy, query.occupancy[-1])
+
+    ax.fill_between(x, y1, y1 + height * identity, step="post",
+                    facecolor="tab:blue", alpha=0.5, linewidth=0)
+    ax.step(x, y1 + height * occupancy, where="post", color="grey", linewidth=0.5)
+    ax.text(-10, y1 + height / 2, "IDENTIDAD", ha='right', size='x-small', va='center')
+    return((y1, y1 + height))
+
+
+def column_summary(query, column):
+    """
+    Devuelve el texto con las estadísticas de una columna del alineamiento
+    del query que se muestra en el plot interactivo.
+    """
+    return("Columna {} · consenso {}\nocupación {:.0%} · identidad {:.0%}".format(
+            column + 1, chr(query.consensus[column]),
+            query.occupancy[column], query.identity[column]))
 
 
 def static_plot(estruct_dir, proteins, queries, query):
     """
     Genera un plot estático, que se almacenará en la carpeta de resultados como
     PNG, y que se utilizará como miniatura para el menú interactivo.
+
+    Sólo se representan los resultados alineados (con '--max-aligned', los
+    representantes de cada grupo).
     """
 
     # Tamaño figura y múltiples subplots
@@ -170,7 +230,7 @@ def static_plot(estruct_dir, proteins, queries, query):
     protein_labels = [] # Almacena las etiquetas. Después se colocarán a la izquierda de cada proteína en orden.
 
     for protein in proteins:
-        if protein.query_id == DEF_QUERY:
+        if protein.query_id == DEF_QUERY and protein.aligned_seq is not None:
             protein_labels.append(( # Almacena etiqueta.
                     y,
                     protein.subject_accs,
@@ -206,6 +266,7 @@ def static_plot(estruct_dir, proteins, queries, query):
             for domain in query.aligned_domains:
                 plot_domain(domain[1], domain[2], y, domain[0], ax, protein.subject_id, False)
             ax.text(-10,y+0.085, "QUERY", ha='right', size='medium', va = 'center')
+            plot_column_statistics(query, y + 0.3, ax)
 
     # Coloca etiquetas a la izquierda de cada proteína, identificándola.
     for label in protein_labels:
@@ -227,14 +288,16 @@ def static_plot(estruct_dir, proteins, queries, query):
     plt.close()
 
 
-def generate_static_graphs(estruct_dir, proteins, queries, Protein_class):
+def generate_static_graphs(estruct_dir, proteins, queries, Protein_class, selection=None):
     """
-    Llama a la función anterior para cada query, y almacena los resultados en
-    la carpeta correspondiente.
+    Llama a la función anterior para cada query (o sólo para los de
+    'selection', si se indica), y almacena los resultados en la carpeta
+    correspondiente.
     """
-    os.mkdir(estruct_dir.file_in_results_dir("plots"))
+    os.makedirs(estruct_dir.file_in_results_dir("plots"), exist_ok=True)
     for query in Protein_class.queries:
-        static_plot(estruct_dir, proteins, queries, query)
+        if selection is None or query in selection:
+            static_plot(estruct_dir, proteins, queries, query)
 
 
 def interactive_plot(selection, proteins, queries, dict_names, estruct_dir):
@@ -253,9 +316,10 @@ def interactive_plot(selection, proteins, queries, dict_names, estruct_dir):
     hover_boxes = []
     protein_labels = []
     DEF_QUERY = selection
+    statistics_band = None # Límites de la banda de estadísticas del query.
 
     for protein in proteins:
-        if protein.query_id == DEF_QUERY:
+        if protein.query_id == DEF_QUERY and protein.aligned_seq is not None:
             protein_labels.append((
                     y,
                     protein.subject_accs,
@@ -287,6 +351,8 @@ def interactive_plot(selection, proteins, queries, dict_names, estruct_dir):
             for domain in query.aligned_domains:
                 plot_domain(domain[1], domain[2], y, domain[0], ax, protein.subject_id, hover_boxes)
             ax.text(-10,y+0.085, "QUERY", ha='right', size='medium', va = 'center')
+            statistics_band = plot_column_statistics(query, y + 0.3, ax)
+            statistics_query = query
 
     # Coloca etiquetas a la izquierda de cada proteína, identificándola.
     for label in protein_labels:
@@ -322,10 +388,20 @@ def interactive_plot(selection, proteins, queries, dict_names, estruct_dir):
         annot.get_bbox_patch().set_alpha(0.4)
 
 
+    def update_column_annot(column, y):
+        """
+        Actualiza el contenido de la anotación con las estadísticas de la
+        columna del alineamiento sobre la que está el ratón.
+        """
+        annot.xy = (column + 0.5, y)
+        annot.set_text(column_summary(statistics_query, column))
+        annot.get_bbox_patch().set_alpha(0.4)
+
     def hover(event):
         """
         Cuando el ratón está sobre un dominio, muestra la anotación, y llama
-        a la función 'update_annot' para actualizar su contenido.
+        a la función 'update_annot' para actualizar su contenido. Sobre la
+        banda de estadísticas del query, muestra las de esa columna.
         """
         vis = annot.get_visible()
         if event.inaxes == ax:
@@ -337,6 +413,13 @@ def interactive_plot(selection, proteins, queries, dict_names, estruct_dir):
                     update_annot(artist)
                     annot.set_visible(True)
                     fig.canvas.draw_idle()
+            if (not an_artist_is_hovered and statistics_band is not None
+                    and statistics_band[0] <= event.ydata <= statistics_band[1]
+                    and 0 <= event.xdata < len(statistics_query.identity)):
+                an_artist_is_hovered = True
+                update_column_annot(int(event.xdata), event.ydata)
+                annot.set_visible(True)
+                fig.canvas.draw_idle()
             if not an_artist_is_hovered:
                 # Si el ratón no está sobre un dominio, oculta la anotación.
                 annot.set_visible(False)
@@ -347,7 +430,7 @@ def interactive_plot(selection, proteins, queries, dict_names, estruct_dir):
         Abre el pop-up de información extendida si se hace clic sobre un
         dominio.
         """
-        print("Ha hecho clic en un dominio. Se está abriendo la ventana de información expandida. (Esto puede tardar unos segundos.)")
+        print("Ha hecho clic en un dominio. Se está abriendo la ventana de información expandida.")
 
         selection = event.artist.get_label()
         fields = selection.split("&")
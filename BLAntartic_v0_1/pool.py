@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+#
+# BLAntarctic v0.1 - 'pool' module
+#
+# Creación de pools de procesos para las etapas que se paralelizan.
+#
+
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+
+def process_pool(workers, initializer=None, initargs=()):
+    """
+    Devuelve un 'ProcessPoolExecutor' con 'workers' procesos.
+
+    Siempre que el sistema lo permita, los procesos se crean con 'fork': así
+    no vuelven a importar 'BLAntractic.py' (que no está protegido con
+    "if __name__ == '__main__'") y heredan lo que ya esté cargado en memoria.
+    """
+    if "fork" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("fork")
+    else:
+        context = None
+
+    return(ProcessPoolExecutor(max_workers=workers,
+                               mp_context=context,
+                               initializer=initializer,
+                               initargs=initargs))
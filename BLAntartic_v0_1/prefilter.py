@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+#
+# BLAntarctic v0.1 - 'prefilter' module
+#
+# Prefiltro de k-meros previo al BLAST: sólo se buscan las proteínas de los
+# genomas que comparten suficientes semillas (k-meros en un alfabeto
+# reducido) con algún query, en la misma diagonal. Útil con paneles de
+# cientos de genomas.
+#
+
+import numpy as np
+
+
+# Alfabeto reducido de 10 letras (Murphy et al., 2000): los aminoácidos de
+# cada grupo se consideran equivalentes al buscar semillas.
+REDUCED_ALPHABET = ("LVIM", "C", "A", "G", "ST", "P", "FYW", "EDNQ", "KR", "H")
+
+KMER_SIZE = 5
+
+# Anchura de las bandas de diagonales en las que se cuentan las semillas:
+# las de un homólogo caen en la misma banda aunque haya pequeñas indels.
+BAND_WIDTH = 32
+
+# Bytes del multifasta que se procesan a la vez.
+CHUNK_SIZE = 1 << 24
+
+# Valor de los caracteres que no son residuos (o que no están en el
+# alfabeto reducido, como X): ningún k-mero puede contenerlos.
+INVALID = 255
+
+
+def reduction_table():
+    """
+    Devuelve la tabla (256 valores) que convierte cada byte en su grupo del
+    alfabeto reducido, o en INVALID.
+    """
+    table = np.full(256, INVALID, dtype=np.uint8)
+    for code, group in enumerate(REDUCED_ALPHABET):
+        for residue in group:
+            table[ord(residue)] = code
+            table[ord(residue.lower())] = code
+    return(table)
+
+_TABLE = reduction_table()
+
+
+def kmer_codes(classes, k=KMER_SIZE):
+    """
+    Calcula el código de cada k-mero de un array de residuos ya reducidos
+    ('classes', ver 'reduction_table'). Devuelve una tupla (codes, valid): el
+    código de cada posición y si el k-mero de esa posición es válido (no
+    contiene ningún INVALID).
+    """
+    n = len(classes) - k + 1
+    if n <= 0:
+        return(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=bool))
+
+    codes = np.zeros(n, dtype=np.int64)
+    for i in range(k):
+        codes = codes * len(REDUCED_ALPHABET) + classes[i:i+n]
+
+    invalid = np.concatenate(([0], np.cumsum(classes == INVALID)))
+    valid = (invalid[k:k+n] - invalid[:n]) == 0
+    return(codes, valid)
+
+
+def seed_table(sequence, k=KMER_SIZE):
+    """
+    Devuelve una tabla con una posición por código de k-mero, que contiene
+    la posición del k-mero en la secuencia (la última, si aparece varias
+    veces), o -1 si no está.
+    """
+    residues = np.frombuffer(sequence.encode(), dtype=np.uint8)
+    codes, valid = kmer_codes(_TABLE[residues], k)
+    table = np.full(len(REDUCED_ALPHABET) ** k, -1, dtype=np.int64)
+    positions = np.nonzero(valid)[0]
+    table[codes[positions]] = positions
+    return(table)
+
+
+def best_band(owners, diagonals, n):
+    """
+    Devuelve, para cada una de las 'n' secuencias, el número máximo de
+    semillas que caen en una misma banda de diagonales. 'owners' y
+    'diagonals' indican la secuencia y la diagonal (no negativa) de cada
+    semilla.
+    """
+    best = np.zeros(n, dtype=np.int64)
+    if len(owners) == 0:
+        return(best)
+
+    bands = int(diagonals.max()) // BAND_WIDTH + 2
+    # Dos particiones desplazadas media banda, para no separar las semillas
+    # cercanas al borde de una banda.
+    for shift in (0, BAND_WIDTH // 2):
+        keys, counts = np.unique(owners * bands + (diagonals + shift) // BAND_WIDTH,
+                                 return_counts=True)
+        np.maximum.at(best, keys // bands, counts)
+    return(best)
+
+
+def select_subjects(seq_store, query_store, min_seeds, k=KMER_SIZE):
+    """
+    Recorre las secuencias de 'seq_store' (el multifasta de genomas) y
+    devuelve una tupla (kept, total, total_length): los ids de las que
+    comparten al menos 'min_seeds' k-meros con alguno de los queries de
+    'query_store' en una misma banda de diagonales (ver 'best_band'), el
+    número de secuencias analizadas y la suma de sus longitudes.
+
+    Si varios ids apuntan a la misma secuencia (modo 'dedup'), sólo se
+    tiene en cuenta el primero, que es el que aparece en el multifasta.
+    """
+    query_tables = [seed_table(query_store.get(query), k) for query in query_store.offsets]
+    union = np.logical_or.reduce([table >= 0 for table in query_tables])
+
+    # Una entrada por secuencia del fichero: (offset, longitud, id).
+    spans = {}
+    for seq_id, span in seq_store.offsets.items():
+        spans.setdefault(span, seq_id)
+    spans = sorted((offset, length, seq_id) for (offset, length), seq_id in spans.items())
+
+    kept = []
+    with open(seq_store.fasta_path, 'rb') as input:
+        start = 0
+        while start < len(spans):
+            # Lote de secuencias consecutivas que ocupen unos CHUNK_SIZE bytes.
+            end = start + 1
+            while (end < len(spans)
+                   and spans[end][0] + spans[end][1] - spans[start][0] <= CHUNK_SIZE):
+                end += 1
+            batch = spans[start:end]
+            base = batch[0][0]
+
+            input.seek(base)
+            content = input.read(batch[-1][0] + batch[-1][1] - base)
+            classes = _TABLE[np.frombuffer(content, dtype=np.uint8)]
+
+            # Todo lo que no sea secuencia (headers, saltos de línea) se
+            # marca como INVALID.
+            starts = np.array([offset - base for offset, length, seq_id in batch])
+            ends = starts + np.array([length for offset, length, seq_id in batch])
+            inside = np.zeros(len(classes) + 1, dtype=np.int64)
+            np.add.at(inside, starts, 1)
+            np.add.at(inside, ends, -1)
+            classes[np.cumsum(inside)[:-1] == 0] = INVALID
+
+            codes, valid = kmer_codes(classes, k)
+
+            # Sólo se comprueba cada query en las posiciones con alguna
+            # semilla, que son muy pocas.
+            positions = np.nonzero(valid)[0]
+            positions = positions[union[codes[positions]]]
+            owners = np.searchsorted(starts, positions, side='right') - 1
+            hit_codes = codes[positions]
+
+            subject_positions = positions - starts[owners]
+
+            passed = np.zeros(len(batch), dtype=bool)
+            for table in query_tables:
+                query_positions = table[hit_codes]
+                seed = query_positions >= 0
+                diagonals = subject_positions[seed] - query_positions[seed] + len(table)
+                passed |= best_band(owners[seed], diagonals, len(batch)) >= min_seeds
+
+            kept.extend(batch[i][2] for i in np.nonzero(passed)[0])
+            start = end
+
+    total_length = sum(length for offset, length, seq_id in spans)
+    return(kept, len(spans), total_length)
+
+
+def write_subset(estruct_dir, seq_store, kept):
+    """
+    Escribe el multifasta con las secuencias seleccionadas
+    ('prefiltered_multifasta.fa', en la carpeta de datos) y devuelve su path.
+    """
+    path = estruct_dir.file_in_data_dir('prefiltered_multifasta.fa')
+    with open(path, 'w') as out:
+        for seq_id in kept:
+            out.write(">{}\n{}\n\n".format(seq_id, seq_store.get(seq_id)))
+    return(path)
+
+
+def recall_report(estruct_dir, expected, obtained, kept, total):
+    """
+    Compara los resultados del BLAST sobre las secuencias prefiltradas
+    ('obtained') con los de un BLAST sobre todas las secuencias
+    ('expected'), ambos como conjuntos de pares (query, subject), y escribe
+    en la carpeta de resultados un resumen ('prefilter_report.txt') con el
+    recall del prefiltro y los resultados perdidos. Devuelve el recall.
+    """
+    found = expected & obtained
+    recall = len(found) / len(expected) if expected else 1.0
+
+    with open(estruct_dir.file_in_results_dir("prefilter_report.txt"), 'w') as out:
+        out.write("Secuencias analizadas:\t{}\n".format(total))
+        out.write("Secuencias tras el prefiltro:\t{}\n".format(len(kept)))
+        out.write("Resultados sin prefiltro:\t{}\n".format(len(expected)))
+        out.write("Resultados con prefiltro:\t{}\n".format(len(found)))
+        out.write("Recall:\t{:.4f}\n".format(recall))
+        missed = sorted(expected - obtained)
+        if missed:
+            out.write("\nResultados perdidos:\n")
+            for query, subject in missed:
+                out.write("{}\t{}\n".format(query, subject))
+
+    return(recall)
@@ -5,12 +5,19 @@
 # Búsqueda de dominios conservados.
 #
 
+import io
 import os
 import re
+import pickle
+from collections import Counter
 
 from Bio.ExPASy import Prosite
 from Bio.ExPASy import Prodoc
 
+import blastp
+import cache
+import pool
+
 def convert_RE(expression):
     """
     Convierte las expresiones regulares del fichero 'prosite.dat' al formato
@@ -32,67 +39,533 @@ def convert_RE(expression):
 
     return str(expression)
 
+# Versión del formato del banco de patrones guardado en disco. Si cambia el
+# contenido de las entradas, se debe incrementar para invalidar los bancos
+# generados por versiones anteriores.
+BANK_VERSION = 1
+
+# El banco se guarda en la carpeta 'prosite' de la caché (ver
+# 'cache.cache_dir'), no en la del paquete.
+BANK_NAME = 'prosite_bank.pkl'
+DAT_PATH = './prosite.dat'
+
+# Banco ya cargado en esta sesión.
+_loaded_bank = None
+
+
+def build_prosite_bank(dat_path=DAT_PATH):
+    """
+    Parsea 'prosite.dat' y devuelve una lista de tuplas (accession, nombre,
+    skip_flag, patrón convertido), una por cada record que tiene patrón.
+    """
+    bank = []
+    with open(dat_path, 'r') as handle:
+        records = Prosite.parse(handle)
+        for record in records:
+            if record.pattern != "": # Hay algunos records que no tienen patrón.
+                bank.append((
+                        str(record.accession),
+                        str(record.name),
+                        record.cc_skip_flag == "TRUE",
+                        convert_RE(record.pattern)))
+    return(bank)
+
+
+def load_prosite_bank(dat_path=DAT_PATH, bank_path=None):
+    """
+    Recupera el banco de patrones de PROSITE guardado en disco, o lo
+    construye (y lo guarda) si no existe o ya no corresponde con el
+    'prosite.dat' actual.
+
+    El banco se considera válido si coincide la versión y la fecha de
+    modificación de 'prosite.dat'. Si sólo ha cambiado la fecha, se comprueba
+    el hash del fichero antes de descartarlo. Por defecto, 'bank_path' es
+    'BANK_NAME' en la caché.
+    """
+    global _loaded_bank
+
+    mtime = os.stat(dat_path).st_mtime
+    if (_loaded_bank is not None and _loaded_bank['path'] == dat_path
+            and _loaded_bank['mtime'] == mtime):
+        return(_loaded_bank['bank'])
+
+    if bank_path is None:
+        bank_path = "{}/{}".format(cache.cache_dir("prosite"), BANK_NAME)
+
+    stored = None
+
+    try:
+        with open(bank_path, 'rb') as input:
+            stored = pickle.load(input)
+        if stored['version'] != BANK_VERSION:
+            stored = None
+    except:
+        # No existe o no se puede leer: se reconstruye.
+        stored = None
+
+    if stored is None or stored['mtime'] != mtime:
+        dat_hash = cache.hash_file(dat_path)
+        if stored is None or stored['hash'] != dat_hash:
+            stored = {'version': BANK_VERSION,
+                      'hash': dat_hash,
+                      'bank': build_prosite_bank(dat_path)}
+        stored['mtime'] = mtime
+
+        # La caché es compartida: se escribe en un fichero temporal y se
+        # renombra, para que otra ejecución nunca lea un banco a medias.
+        temp = "{}.{}.tmp".format(bank_path, os.getpid())
+        with open(temp, 'wb') as output:
+            pickle.dump(stored, output, pickle.HIGHEST_PROTOCOL)
+        os.replace(temp, bank_path)
+
+    _loaded_bank = dict(stored, path=dat_path)
+    return(stored['bank'])
+
+
+def bank_signature(dat_path=DAT_PATH):
+    """
+    Devuelve una cadena que identifica el banco de patrones: la versión de
+    su formato y el hash de 'prosite.dat' (ver 'load_prosite_bank'). Los
+    resultados de la búsqueda de dominios dependen de ella.
+    """
+    load_prosite_bank(dat_path)
+    return("{}:{}".format(BANK_VERSION, _loaded_bank['hash']))
+
+
 def create_prosite_dict(exclude = False):
     """
-    Crea dos diccionarios: uno que relaciona los patrones RE de cada dominio
-    con el número de accessión del mismo ('dict_pattern'), y otro que relaciona el número de accesión con el nombre común ('dict_names').
+    Crea dos diccionarios: uno que relaciona los patrones RE (ya compilados)
+    de cada dominio con el número de accessión del mismo ('dict_pattern'), y
+    otro que relaciona el número de accesión con el nombre común
+    ('dict_names').
+
+    Los patrones se obtienen del banco guardado en disco (ver
+    'load_prosite_bank'), por lo que 'prosite.dat' sólo se parsea cuando
+    cambia.
 
     Además, si el parámetro 'exclude' es 'True', se excluyen del diciconario
     dominios con alta probabilidad de ocurrencia (sistios de fosforilación,
     etc.), que contienen la etiqueta '/SKIP-FLAG=TRUE>' (ver manual de ScanProsite para más información.)
     """
-    dict_pattern = {}
+    patterns = {}
     dict_names = {}
-    with open('./prosite.dat','r') as handle:
-        records = Prosite.parse(handle)
-        for record in records:
-            if record.pattern != "": # Hay algunos records que no tienen patrón.
-                if exclude == False:
-                    converted_RE = convert_RE(record.pattern)
-                    # Recupera el nombre y accessión del dominio.
-                    dict_pattern[converted_RE] = str(record.accession)
-                    dict_names[str(record.accession)] = str(record.name)
-                else:
-                    if not record.cc_skip_flag == "TRUE":
-                        converted_RE = convert_RE(record.pattern)
-                        # Recupera el nombre y accessión del dominio.
-                        dict_pattern[converted_RE] = str(record.accession)
-                        dict_names[str(record.accession)] = str(record.name)
+    for accession, name, skip_flag, converted_RE in load_prosite_bank():
+        if exclude and skip_flag:
+            continue
+        patterns[converted_RE] = accession
+        dict_names[accession] = name
+
+    # Compila cada patrón una única vez para toda la sesión.
+    dict_pattern = {}
+    for converted_RE, accession in patterns.items():
+        dict_pattern[re.compile(converted_RE)] = accession
 
     return dict_pattern, dict_names
 
 
-def search_domains(estruct_dir, proteins, Protein_class, dict_pattern):
+# Índice de acceso directo a los records de 'prosite.dat' y 'prosite.doc',
+# guardado, como el banco de patrones, en la carpeta 'prosite' de la caché.
+INDEX_VERSION = 1
+INDEX_NAME = 'prosite_index.pkl'
+DOC_PATH = './prosite.doc'
+
+# Índice ya cargado en esta sesión.
+_loaded_index = None
+
+
+def file_signature(path):
+    """
+    Tamaño y fecha de modificación de un fichero, para saber si ha cambiado.
+    """
+    stat = os.stat(path)
+    return((stat.st_size, stat.st_mtime))
+
+
+def index_records(path, is_start, is_end, accession_of):
+    """
+    Recorre un fichero de la base de datos en modo binario y devuelve un
+    diccionario que relaciona el accession de cada record con su posición
+    (en bytes) y su longitud dentro del fichero.
+
+    'is_start' e 'is_end' indican si una línea abre o cierra un record, y
+    'accession_of' extrae el accession de una línea (o devuelve 'None').
+    """
+    index = {}
+    offset = 0
+    start = None
+    accession = None
+
+    with open(path, 'rb') as handle:
+        for line in handle:
+            if is_start(line):
+                start = offset
+                accession = None
+            if start is not None and accession is None:
+                accession = accession_of(line)
+            offset += len(line)
+            if start is not None and is_end(line):
+                if accession is not None:
+                    index[accession] = (start, offset - start)
+                start = None
+
+    return(index)
+
+
+def build_prosite_index(dat_path=DAT_PATH, doc_path=DOC_PATH):
+    """
+    Construye los índices de 'prosite.dat' (por accession PSxxxxx) y
+    'prosite.doc' (por accession PDOCxxxxx).
+    """
+    dat_index = index_records(
+            dat_path,
+            lambda line: line.startswith(b"ID   "),
+            lambda line: line.startswith(b"//"),
+            lambda line: (line[5:].split(b";")[0].strip().decode()
+                          if line.startswith(b"AC   ") else None))
+
+    doc_index = index_records(
+            doc_path,
+            lambda line: line.startswith(b"{PDOC"),
+            lambda line: line.startswith(b"{END}"),
+            lambda line: (line.strip()[1:-1].decode()
+                          if line.startswith(b"{PDOC") else None))
+
+    return(dat_index, doc_index)
+
+
+def load_prosite_index(dat_path=DAT_PATH, doc_path=DOC_PATH, index_path=None):
+    """
+    Devuelve los índices de 'prosite.dat' y 'prosite.doc' (ver
+    'build_prosite_index'). Se construyen una única vez y se guardan en disco;
+    sólo se reconstruyen si alguno de los dos ficheros cambia. Por defecto,
+    'index_path' es 'INDEX_NAME' en la caché.
+    """
+    global _loaded_index
+
+    signature = (INDEX_VERSION, file_signature(dat_path), file_signature(doc_path))
+
+    if _loaded_index is not None and _loaded_index['signature'] == signature:
+        return(_loaded_index['dat'], _loaded_index['doc'])
+
+    if index_path is None:
+        index_path = "{}/{}".format(cache.cache_dir("prosite"), INDEX_NAME)
+
+    try:
+        with open(index_path, 'rb') as input:
+            stored = pickle.load(input)
+        if stored['signature'] != signature:
+            stored = None
+    except:
+        stored = None
+
+    if stored is None:
+        dat_index, doc_index = build_prosite_index(dat_path, doc_path)
+        stored = {'signature': signature, 'dat': dat_index, 'doc': doc_index}
+        temp = "{}.{}.tmp".format(index_path, os.getpid())
+        with open(temp, 'wb') as output:
+            pickle.dump(stored, output, pickle.HIGHEST_PROTOCOL)
+        os.replace(temp, index_path)
+
+    _loaded_index = stored
+    return(stored['dat'], stored['doc'])
+
+
+def read_indexed(path, index, accession, encoding):
+    """
+    Lee del fichero 'path' únicamente el record 'accession', usando 'index'.
+    """
+    offset, length = index[accession]
+    with open(path, 'rb') as handle:
+        handle.seek(offset)
+        return(handle.read(length).decode(encoding))
+
+
+def read_prosite_record(accession, dat_path=DAT_PATH, doc_path=DOC_PATH):
+    """
+    Devuelve el record de 'prosite.dat' (Bio.ExPASy.Prosite.Record) con ese
+    accession.
+    """
+    dat_index, doc_index = load_prosite_index(dat_path, doc_path)
+    text = read_indexed(dat_path, dat_index, accession, 'utf-8')
+    return(Prosite.read(io.StringIO(text)))
+
+
+def read_prodoc_record(accession, dat_path=DAT_PATH, doc_path=DOC_PATH):
+    """
+    Devuelve el record de 'prosite.doc' (Bio.ExPASy.Prodoc.Record) con ese
+    accession (PDOCxxxxx).
+    """
+    dat_index, doc_index = load_prosite_index(dat_path, doc_path)
+    text = read_indexed(doc_path, doc_index, accession, 'latin1')
+    return(Prodoc.read(io.StringIO(text)))
+
+
+# Tablas para 'bytes.translate' que convierten una secuencia en una cadena
+# de '0' y '1' (un '1' en cada posición donde aparece el residuo).
+_BIT_TABLES = {
+        residue: bytes(49 if i == ord(residue) else 48 for i in range(256))
+        for residue in "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+}
+
+
+def analyze_pattern(expression):
+    """
+    Analiza un patrón ya convertido (ver 'convert_RE') y extrae la información
+    necesaria para descartar secuencias sin llegar a evaluar la expresión
+    regular:
+
+     - 'required': tupla de pares (residuo, n) con los residuos que aparecen
+       obligatoriamente en cualquier match, y cuántas veces como mínimo.
+     - 'anchors': tupla de pares (offset, residuo) con las posiciones fijas
+       de residuos obligatorios dentro del tramo de longitud fija del patrón
+       que más contiene. Los offsets son relativos entre sí.
+
+    Si el patrón contiene alguna construcción no prevista, devuelve 'None', y
+    el patrón se evaluará siempre.
+    """
+    elements = []
+    i = 0
+    n = len(expression)
+
+    while i < n:
+        char = expression[i]
+
+        if char in "^$":
+            # Sólo se admiten como anclas de inicio o final.
+            if i == 0 or i == n-1:
+                i += 1
+                continue
+            return None
+        elif char == '.':
+            literal = None
+        elif char == '[':
+            close = expression.find(']', i)
+            if close < 0:
+                return None
+            body = expression[i+1:close]
+            # Sólo un residuo, y no negado: es un residuo fijo.
+            if len(body) == 1 and body in _BIT_TABLES:
+                literal = body
+            else:
+                literal = None
+            i = close
+        elif char in _BIT_TABLES:
+            literal = char
+        else:
+            return None
+        i += 1
+
+        # Repeticiones: {n} o {n,m}.
+        minimum = maximum = 1
+        if i < n and expression[i] == '{':
+            close = expression.find('}', i)
+            if close < 0:
+                return None
+            try:
+                limits = [int(x) for x in expression[i+1:close].split(',')]
+            except ValueError:
+                return None
+            minimum, maximum = limits[0], limits[-1]
+            i = close + 1
+
+        elements.append((literal, minimum, maximum))
+
+    required = Counter()
+    anchors = []
+    segment = []
+    offset = 0
+    for literal, minimum, maximum in elements:
+        if literal is not None:
+            required[literal] += minimum
+        if minimum != maximum:
+            # Un elemento de longitud variable corta el tramo fijo.
+            if len(segment) > len(anchors):
+                anchors = segment
+            segment = []
+            offset = 0
+            continue
+        if literal is not None:
+            for k in range(minimum):
+                segment.append((offset + k, literal))
+        offset += minimum
+    if len(segment) > len(anchors):
+        anchors = segment
+
+    return(tuple(required.items()), tuple(anchors))
+
+
+class DomainScanner:
+    """
+    Motor de búsqueda de dominios. Para cada patrón almacena los residuos
+    obligatorios y sus posiciones fijas (ver 'analyze_pattern'), de forma que
+    sólo se evalúa la expresión regular sobre las secuencias que pueden
+    contener un match.
+
+    Los resultados son idénticos a evaluar todas las expresiones sobre
+    todas las secuencias, en el mismo orden.
+    """
+
+    def __init__(self, dict_pattern):
+        self.entries = []
+        for pattern, accession in dict_pattern.items():
+            compiled = re.compile(pattern)
+            analysis = analyze_pattern(compiled.pattern)
+            if analysis is None:
+                required, anchors = (), ()
+            else:
+                required, anchors = analysis
+            self.entries.append((compiled, accession, required, anchors))
+
+    def scan(self, sequence):
+        """
+        Devuelve una lista de tuplas (accession, start, end) con todos los
+        matches de los patrones en 'sequence'.
+        """
+        counts = Counter(sequence)
+        masks = {}
+        # El '0' inicial evita errores con secuencias vacías.
+        reversed_seq = b"0" + sequence[::-1].encode()
+        found = []
+
+        for compiled, accession, required, anchors in self.entries:
+            # Primer filtro: la secuencia contiene suficientes residuos de
+            # cada tipo obligatorio.
+            if any(counts[residue] < times for residue, times in required):
+                continue
+
+            # Segundo filtro: existe alguna posición donde coinciden todos los
+            # residuos fijos del tramo. Se comprueba con máscaras de bits (un
+            # bit por posición de la secuencia para cada residuo).
+            if len(anchors) > 1:
+                candidates = -1
+                for offset, residue in anchors:
+                    mask = masks.get(residue)
+                    if mask is None:
+                        mask = int(reversed_seq.translate(_BIT_TABLES[residue]), 2)
+                        masks[residue] = mask
+                    candidates &= mask >> offset
+                    if not candidates:
+                        break
+                if not candidates:
+                    continue
+
+            for match in compiled.finditer(sequence):
+                found.append((accession, match.start(), match.end()))
+
+        return(found)
+
+
+# Escáner de cada proceso del pool (ver 'scan_sequences').
+_worker_scanner = None
+
+
+def init_worker(dict_pattern):
+    """
+    Inicializa un proceso del pool: construye su escáner una única vez, con
+    los patrones ya compilados.
+    """
+    global _worker_scanner
+    _worker_scanner = DomainScanner(dict_pattern)
+
+
+def scan_shard(sequences):
+    """
+    Busca dominios en un bloque de secuencias, dentro de un proceso del pool.
+    """
+    return([_worker_scanner.scan(sequence) for sequence in sequences])
+
+
+def scan_sequences(sequences, dict_pattern, workers=1):
+    """
+    Busca dominios en una lista de secuencias. Devuelve una lista con los
+    matches (tuplas (accession, start, end)) de cada secuencia, en el mismo
+    orden que 'sequences'.
+
+    Si 'workers' es mayor que 1, las secuencias se reparten en bloques entre
+    un pool de procesos. Los patrones se envían a cada proceso una única vez,
+    al crearlo.
+    """
+    if workers <= 1 or len(sequences) < 2:
+        scanner = DomainScanner(dict_pattern)
+        return([scanner.scan(sequence) for sequence in sequences])
+
+    # Varios bloques por proceso, para repartir mejor la carga.
+    n_shards = min(len(sequences), workers * 4)
+    size = -(-len(sequences) // n_shards)
+    shards = [sequences[i:i+size] for i in range(0, len(sequences), size)]
+
+    results = []
+    with pool.process_pool(workers, init_worker, (dict_pattern,)) as executor:
+        # 'map' devuelve los bloques en orden, así que el resultado no
+        # depende del orden en que terminen los procesos.
+        for shard_results in executor.map(scan_shard, shards):
+            results.extend(shard_results)
+
+    return(results)
+
+
+def scan_missing(sequences, dict_pattern, workers=1, found=None):
+    """
+    Devuelve un diccionario con los matches de cada secuencia de
+    'sequences' (ver 'scan_sequences'). Si se indica 'found' (un diccionario
+    secuencia -> matches ya buscados, p. ej. por 'scheduler'), sólo se
+    analizan las que no estén en él.
+    """
+    results = dict(found) if found else {}
+    missing = [sequence for sequence in dict.fromkeys(sequences) if sequence not in results]
+    results.update(zip(missing, scan_sequences(missing, dict_pattern, workers)))
+    return(results)
+
+
+def search_domains(estruct_dir, proteins, Protein_class, dict_pattern, workers=1, found=None):
     """
     Recorre todas las instancias de 'Protein', y busca en su secuencia de
     aminoácidos coincidencias con alguna de las expresiones regulares de
-    el diccionario de Prosite.
+    el diccionario de Prosite (mediante 'DomainScanner', repartiendo el
+    trabajo entre 'workers' procesos). Las secuencias repetidas (ver
+    'Protein.sequences') se analizan una única vez, y las de 'found' (ver
+    'scan_missing') no se analizan.
 
     Almacena los matches en la lista 'self.domains' de la instancia
     correspondiente, en forma de tuplas (accession, start, end).
     """
-    for query in Protein_class.queries:
-        for protein in proteins:
-            if protein.query_id == query:
-                for pattern in list(dict_pattern.keys()):
-                    ungapped_seq = protein.subject_seq.replace("-", "")
-                    matches = re.finditer(pattern, ungapped_seq)
-                    for match in matches:
-                        protein.add_domain(
-                                dict_pattern[pattern],
-                                match.start(),
-                                match.end()
-                                )
+    # Cada secuencia distinta se analiza una sola vez, aunque la hayan
+    # encontrado varios queries.
+    unique_ids = list(dict.fromkeys(protein.seq_id for protein in proteins))
+    sequences = {seq_id: Protein_class.sequences[seq_id].replace("-", "") for seq_id in unique_ids}
+    results = scan_missing(list(sequences.values()), dict_pattern, workers, found)
+
+    for protein in proteins:
+        for accession, start, end in results[sequences[protein.seq_id]]:
+            protein.add_domain(accession, start, end)
+
+
+def search_query_domains(queries, dict_pattern, workers=1, found=None):
+    """
+    Igual que 'search_domains', pero para las instancias de 'muscle.Query',
+    a partir de su secuencia alineada (sin guiones). Los proyectos
+    anteriores la guardan como texto (ver 'blastp.alignment_bytes').
+    """
+    sequences = [blastp.alignment_bytes(query.aligned_seq).replace(b"-", b"").decode()
+                 for query in queries]
+    results = scan_missing(sequences, dict_pattern, workers, found)
+
+    for query, sequence in zip(queries, sequences):
+        for accession, start, end in results[sequence]:
+            query.add_domain(accession, start, end)
 
 
-def output_domains(estruct_dir, proteins, Protein_class, dict_names):
+def output_domains(estruct_dir, proteins, Protein_class, dict_names, queries=None):
     """
     Genera un archivo de texto separado con tabulaciones con los dominios
-    encontrados para cada query.
+    encontrados para cada query (o sólo para los de 'queries', si se
+    indica).
     """
-    os.mkdir(estruct_dir.file_in_results_dir("protein_domains"))
+    os.makedirs(estruct_dir.file_in_results_dir("protein_domains"), exist_ok=True)
 
     for query in Protein_class.queries:
+        if queries is not None and query not in queries:
+            continue
         with open(estruct_dir.file_in_results_dir("protein_domains/{}_domains.tsv".format(query)), 'w') as out:
 
             out_txt = ""
@@ -5,16 +5,28 @@
 # Gestión de ficheros *.bapj.
 #
 
+import os
 import pickle
 
-def save(estruct_dir, proteins, queries, Protein_class, dict_names):
+def save(estruct_dir, proteins, queries, Protein_class, dict_names, settings=None):
     """
     Vuelca en un fichero el contenido de los objectos necesarios para reanudar
     la ejecución del script más tarde.
+
+    'settings' es un diccionario con los parámetros de la ejecución
+    (umbrales, etc.), necesarios para volver a filtrar los resultados.
+
+    Antes se eliminan de la tabla de secuencias las que no usa ninguna
+    instancia de 'proteins' (ver 'Protein.compact_sequences'), para que no
+    se acumulen al volver a filtrar el proyecto.
     """
+    Protein_class.compact_sequences(proteins)
     path = estruct_dir.file_in_results_dir("project.bapj")
     queries_list = Protein_class.queries
-    all_objects = (estruct_dir, proteins, queries, queries_list, dict_names)
+    accessions_list = Protein_class.accessions.values
+    sequences_list = Protein_class.sequences.values
+    all_objects = (estruct_dir, proteins, queries, queries_list, dict_names,
+                   accessions_list, sequences_list, settings)
     with open(path, 'wb') as output:
         pickle.dump(all_objects, output, pickle.HIGHEST_PROTOCOL)
 
@@ -26,3 +38,44 @@ def open_project(path):
         all_objects = pickle.load(input)
 
     return(all_objects)
+
+
+def save_checkpoint(estruct_dir, stage, objects, Protein_class):
+    """
+    Guarda el estado en memoria al terminar una etapa del análisis (los
+    objetos de 'objects' y las tablas de la clase Protein), en la carpeta
+    'checkpoints' de los datos, para poder reanudar desde ella.
+    """
+    path = checkpoint_path(estruct_dir, stage)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    state = (objects, Protein_class.queries, Protein_class.accessions.values,
+             Protein_class.sequences.values)
+    with open(path + ".tmp", 'wb') as output:
+        pickle.dump(state, output, pickle.HIGHEST_PROTOCOL)
+    os.replace(path + ".tmp", path)
+
+    return(path)
+
+
+def checkpoint_path(estruct_dir, stage):
+    """
+    Devuelve el path del fichero de 'save_checkpoint' de una etapa (el que
+    se declara como salida de la etapa en el manifiesto).
+    """
+    return estruct_dir.file_in_data_dir("checkpoints/{}.pkl".format(stage))
+
+
+def load_checkpoint(estruct_dir, stage, Protein_class):
+    """
+    Recupera el estado guardado con 'save_checkpoint' (restaurando las
+    tablas de la clase Protein) y devuelve los objetos guardados.
+    """
+    with open(checkpoint_path(estruct_dir, stage), 'rb') as input:
+        objects, queries_list, accessions_list, sequences_list = pickle.load(input)
+
+    Protein_class.import_queries_list(queries_list)
+    Protein_class.import_accessions_list(accessions_list)
+    Protein_class.import_sequences_list(sequences_list)
+
+    return(objects)
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+#
+# BLAntarctic v0.1 - 'scheduler' module
+#
+# Ejecución solapada del BLAST, el alineamiento, el árbol y la búsqueda de
+# dominios ('--pipeline'): cada query es una tarea de asyncio que pasa a la
+# siguiente etapa en cuanto termina la anterior, sin esperar al resto de
+# queries.
+#
+
+import asyncio
+import os
+from subprocess import PIPE, DEVNULL, CalledProcessError
+
+import blastp
+import muscle
+import pool
+import prosite
+
+
+class PipelineResults:
+    """
+    Resultados de 'run_pipeline': los del BLAST ('proteins', instancias de
+    Protein), los queries alineados ('queries', instancias de
+    'muscle.Query') y los dominios encontrados en cada secuencia ('domains',
+    ver 'prosite.scan_missing'). 'aligned' y 'trees' indican si se han hecho
+    los alineamientos y los árboles.
+    """
+
+    def __init__(self, aligned, trees):
+        self.proteins = []
+        self.queries = []
+        self.domains = {}
+        self.aligned = aligned
+        self.trees = trees
+
+
+async def run_command(command, input=None):
+    """
+    Ejecuta un comando externo (con 'asyncio.create_subprocess_exec'),
+    enviándole 'input' (bytes) por stdin, y devuelve una tupla (código de
+    salida, stdout, stderr). Si el programa no se puede ejecutar, el código
+    es 'None'.
+    """
+    try:
+        process = await asyncio.create_subprocess_exec(
+                *command, stdin=PIPE if input is not None else DEVNULL,
+                stdout=PIPE, stderr=PIPE)
+    except OSError as error:
+        return(None, b"", str(error))
+
+    stdout, stderr = await process.communicate(input)
+    return(process.returncode, stdout, stderr.decode(errors="replace"))
+
+
+class Pipeline:
+    """
+    Estado compartido por las tareas de los queries (ver 'run_pipeline').
+
+    'limit' es un semáforo que limita el número de subprocesos y de tareas
+    del pool de procesos que se ejecutan a la vez, sumando las de todos los
+    queries.
+    """
+
+    def __init__(self, estruct_dir, Protein_class, seq_store, query_store, db_path,
+                 evalue, coverage, ident, max_aligned, num_threads, dbsize,
+                 export, executor, jobs, results):
+        self.estruct_dir = estruct_dir
+        self.Protein_class = Protein_class
+        self.seq_store = seq_store
+        self.query_store = query_store
+        self.db_path = db_path
+        self.evalue = evalue
+        self.coverage = coverage
+        self.ident = ident
+        self.max_aligned = max_aligned
+        self.num_threads = num_threads
+        self.dbsize = dbsize
+        self.export = export
+        self.executor = executor
+        self.limit = asyncio.Semaphore(max(1, jobs))
+        self.results = results
+
+        # Salida del BLAST y resultados de cada query.
+        self.lines = {}
+        self.proteins = {}
+        self.aligned = {}
+
+        # Secuencias cuyos dominios ya se están buscando.
+        self.scanning = set()
+
+    async def in_executor(self, function, *args):
+        """
+        Ejecuta una función en el pool de procesos, respetando el límite.
+        """
+        async with self.limit:
+            loop = asyncio.get_running_loop()
+            return(await loop.run_in_executor(self.executor, function, *args))
+
+    async def blast(self, query):
+        """
+        Hace el BLAST de un query (enviando su secuencia por stdin) y crea
+        una instancia de Protein para cada resultado que supere los umbrales
+        (ver 'blastp.parse_blast_results').
+        """
+        command = blastp.blast_command("-", self.db_path,
+                                       max(self.evalue, blastp.PERMISSIVE_EVALUE),
+                                       min(self.coverage, blastp.PERMISSIVE_COVERAGE),
+                                       self.num_threads, self.dbsize)
+        fasta = ">{}\n{}\n".format(query, self.query_store.get(query)).encode()
+        async with self.limit:
+            returncode, stdout, stderr = await run_command(command, fasta)
+        if returncode != 0:
+            raise CalledProcessError(returncode, command, stderr=stderr)
+
+        self.lines[query] = stdout.decode().splitlines(keepends=True)
+
+        proteins = []
+        for line in self.lines[query]:
+            campos = line.rstrip("\n").split("\t")
+            if blastp.passes_thresholds(campos, self.evalue, self.coverage, self.ident):
+                # El índice se asigna al final (ver 'run_pipeline').
+                proteins.append(self.Protein_class(
+                        0, campos[0], campos[1], self.seq_store.get(campos[1]),
+                        campos[3], campos[4], campos[5], campos[6], campos[7]))
+        self.proteins[query] = proteins
+
+    async def scan(self, query, proteins):
+        """
+        Busca dominios en las secuencias de los resultados de un query (y en
+        la del propio query) que no se hayan analizado ya.
+        """
+        sequences = [self.query_store.get(query)] + [
+                self.Protein_class.sequences[protein.seq_id] for protein in proteins]
+        sequences = [sequence for sequence in dict.fromkeys(sequences)
+                     if sequence not in self.scanning]
+        self.scanning.update(sequences)
+        if sequences:
+            found = await self.in_executor(prosite.scan_shard, sequences)
+            self.results.domains.update(zip(sequences, found))
+
+    async def align(self, query, proteins):
+        """
+        Alinea los resultados de un query con MUSCLE (por stdin y stdout,
+        ver 'muscle.multi_align') y, si se indica, hace su árbol (ver
+        'muscle.build_tree').
+        """
+        fasta = blastp.build_multifasta_for_muscle(self.estruct_dir, proteins, self.Protein_class,
+                                                   self.query_store, self.max_aligned, {query},
+                                                   self.export)[query]
+        async with self.limit:
+            returncode, stdout, stderr = await run_command(muscle.MUSCLE_COMMAND, fasta.encode())
+        muscle.report_failure(query, returncode, stderr)
+        if returncode != 0:
+            return
+
+        if self.export:
+            muscle.export_alignment(self.estruct_dir, query, stdout)
+        alignments = {query: muscle.read_alignment(stdout)}
+        for aligned_query in muscle.parse_alignment(self.estruct_dir, proteins, {query}, alignments):
+            self.aligned[query] = aligned_query
+
+        if self.results.trees:
+            await self.in_executor(muscle.build_tree, self.estruct_dir, "kimura", {query}, alignments)
+
+    async def run_query(self, query):
+        """
+        Lleva un query por todas las etapas. La búsqueda de dominios sólo
+        depende del BLAST, así que se hace a la vez que el alineamiento.
+        """
+        await self.blast(query)
+        proteins = self.proteins[query]
+        scanning = asyncio.create_task(self.scan(query, proteins))
+        if proteins and self.results.aligned:
+            await self.align(query, proteins)
+        await scanning
+
+    async def run(self, queries):
+        await asyncio.gather(*(self.run_query(query) for query in queries))
+
+
+def run_pipeline(estruct_dir, Protein_class, seq_store, query_store, db_path,
+                 evalue, coverage, ident, dict_pattern, members=None, hits=None,
+                 max_aligned=None, align=True, trees=True, jobs=1, workers=1,
+                 num_threads=1, dbsize=None, export=False):
+    """
+    Hace el BLAST de cada query, y a continuación (si 'align') el
+    alineamiento múltiple de sus resultados y su árbol (si 'trees'; con
+    'export', ver 'muscle.multi_align'), y busca dominios en
+    sus secuencias, sin esperar a que terminen los demás queries: mientras
+    se alinean los resultados de un query, se puede estar haciendo el BLAST
+    de otro y buscando dominios en los de un tercero.
+
+    El BLAST y MUSCLE se ejecutan como subprocesos de asyncio, y la
+    construcción de los árboles y la búsqueda de dominios en un pool de
+    'workers' procesos. Como mucho se ejecutan 'jobs' de todos ellos a la
+    vez. Como puede haber hasta 'jobs' BLASTs a la vez, los 'num_threads'
+    hilos se reparten entre ellos.
+
+    Los resultados son los mismos que los de las etapas por separado: al
+    final, los del BLAST se ordenan como los queries, y se escriben los
+    mismos ficheros (ver 'blastp.parse_blast_results'). Devuelve un
+    'PipelineResults'.
+    """
+    results = PipelineResults(align, trees and align)
+    queries = list(query_store.offsets)
+
+    if results.trees:
+        os.makedirs(estruct_dir.file_in_results_dir("trees_nw"), exist_ok=True)
+
+    # Hilos de cada BLAST, para no usar en total más de 'num_threads'.
+    blast_threads = max(1, num_threads // max(1, jobs))
+
+    with pool.process_pool(max(1, workers), prosite.init_worker, (dict_pattern,)) as executor:
+        # Los procesos del pool se crean ahora, antes de lanzar ningún
+        # subproceso, para no crearlos (con 'fork') con hilos en marcha.
+        executor.submit(len, ()).result()
+        pipeline = Pipeline(estruct_dir, Protein_class, seq_store, query_store, db_path,
+                            evalue, coverage, ident, max_aligned, blast_threads, dbsize,
+                            export, executor, jobs, results)
+        asyncio.run(pipeline.run(queries))
+
+    # Ficheros de resultados del BLAST y tabla de resultados, en el orden de
+    # los queries (como si se hubiera hecho un único BLAST).
+    lines = [line for query in queries for line in pipeline.lines[query]]
+    for campos in blastp.filter_blast_lines(lines, evalue, coverage, ident,
+                                            estruct_dir.file_in_results_dir("blast_results.tsv"),
+                                            estruct_dir.file_in_results_dir("filtered_blast_results.tsv"),
+                                            members, hits):
+        pass
+
+    for query in queries:
+        for protein in pipeline.proteins[query]:
+            protein.index = len(results.proteins) + 1
+            results.proteins.append(protein)
+        if query in pipeline.aligned:
+            results.queries.append(pipeline.aligned[query])
+    Protein_class.import_queries_list([query for query in queries if pipeline.proteins[query]])
+
+    return(results)